@@ -0,0 +1,191 @@
+"""personal_chatweb 핫패스 벤치마크.
+
+임시 디렉터리에서 앱 모듈을 bare 모드로 import 한 뒤, 합성 기록(한국어/영어 혼합,
+출처 포함/미포함)으로 암호화·샤드 저장/로드·저널 추가·Telegram 병합·HTML 빌드·검색
+색인 시간을 잰다. 결과(처리량, 최대 메모리)는 JSON으로 저장해 실행 간 비교한다.
+
+    python bench_chatweb.py --sizes 10 1000 10000 100000 --out bench.json
+    python bench_chatweb.py --compare bench_old.json bench.json
+"""
+import argparse
+import importlib
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_SIZES = [10, 1000, 10000, 100000]
+
+KO_WORDS = "안녕하세요 오늘 날씨 파이썬 코드 서버 설정 방법 질문 답변 요약 예제 데이터 모델 결과 확인 부탁 정리".split()
+EN_WORDS = "hello world python server config deploy stream token model cache latency query result summary example".split()
+
+
+def load_app(workdir):
+    """앱 모듈을 workdir에서 import (기록 파일이 임시 디렉터리에 생기도록)"""
+    os.chdir(workdir)
+    sys.path.insert(0, REPO_DIR)
+    app = importlib.import_module("personal_chatweb")
+    import streamlit.logger
+    streamlit.logger.set_log_level("error")  # 측정 중 bare 모드 ScriptRunContext 경고 억제
+    return app
+
+
+def synth_text(rng, words=30):
+    pool = KO_WORDS if rng.random() < 0.5 else EN_WORDS
+    return " ".join(rng.choice(pool) for _ in range(rng.randint(words // 3, words)))
+
+
+def synth_messages(n, seed=0):
+    rng = random.Random(seed)
+    messages = []
+    for k in range(n):
+        role = "user" if k % 2 == 0 else "assistant"
+        msg = {"id": f"{k:012x}", "role": role, "content": synth_text(rng, 20 if role == "user" else 120)}
+        if role == "assistant" and rng.random() < 0.3:
+            msg["sources"] = [{"uri": f"https://example.com/{k}/{j}", "title": f"Source {j}"} for j in range(3)]
+        messages.append(msg)
+    return messages
+
+
+def synth_tg_messages(n, seed=1, start_id=1):
+    rng = random.Random(seed)
+    return [{"id": start_id + k, "text": synth_text(rng, 40), "from_me": k % 2 == 0,
+             "date": "12:00", "date_full": "2026-01-01 12:00:00"} for k in range(n)]
+
+
+def measure(fn, repeat, setup=None):
+    """(중앙값 초, 최소 초, 최대 메모리 바이트). 메모리는 별도 1회 실행을 tracemalloc으로 측정."""
+    times = []
+    for _ in range(repeat):
+        arg = setup() if setup else None
+        t0 = time.perf_counter()
+        fn(arg)
+        times.append(time.perf_counter() - t0)
+    arg = setup() if setup else None
+    tracemalloc.start()
+    fn(arg)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return statistics.median(times), min(times), peak
+
+
+def run_size(app, n, repeat, workdir):
+    messages = synth_messages(n)
+    tg_messages = synth_tg_messages(n)
+    payload = json.dumps(messages, ensure_ascii=False)
+    cipher = app.encrypt_data(payload, app.ACCESS_PASSWORD)
+    nbytes = len(payload.encode("utf-8"))
+    root = os.path.join(workdir, f"bench_{n}")
+    os.makedirs(root, exist_ok=True)
+    store = app.SessionStore(root=root)
+    journal = store._shard_journal("bench")
+    journal._write_snapshot(messages, 0)
+    tg_page = synth_tg_messages(min(n, app.TG_PAGE_SIZE), seed=2, start_id=max(1, n - app.TG_PAGE_SIZE // 2))
+    persistence = app.get_persistence()
+
+    def journal_setup():
+        path = os.path.join(root, "append.journal")
+        if os.path.exists(path): os.remove(path)
+        return app.EncryptedJournal(os.path.join(root, "append.dat"), path, app._apply_shard_record, list)
+
+    def journal_append(j):
+        for msg in messages[:200]: j.append({"op": "msg", "msg": msg})
+        persistence.flush()
+
+    def gemini_html(msgs):
+        frags = app.get_fragment_cache()
+        for msg in msgs:
+            if msg["role"] == "assistant":
+                frags.get(("copy", msg["id"], hash(msg["content"])), lambda: app.copy_buttons_html(msg["id"], msg["content"]))
+            if msg.get("sources"):
+                frags.get(("src", msg["id"], hash(msg["content"])), lambda: app.sources_html(msg["sources"]))
+
+    def cold_cache(_=None):
+        app.get_fragment_cache().data.clear()
+
+    def search_index(_=None):
+        index = app.SearchIndex()
+        for k, msg in enumerate(messages): index._add(f"g|bench|{msg['id']}", msg["content"], {"kind": "g", "idx": k})
+        return index
+
+    index = search_index()
+    window = app.GEMINI_RENDER_WINDOW
+    cases = {
+        "encrypt_data": (lambda _: app.encrypt_data(payload, app.ACCESS_PASSWORD), None, nbytes),
+        "decrypt_data": (lambda _: app.decrypt_data(cipher, app.ACCESS_PASSWORD), None, nbytes),
+        "shard_save": (lambda _: journal._write_snapshot(messages, 0), None, n),
+        "shard_load": (lambda _: app.SessionStore(root=root).messages("bench"), None, n),
+        "journal_append_200": (journal_append, journal_setup, min(n, 200)),
+        "tg_merge_full": (lambda msgs: app.merge_tg_messages([], msgs), lambda: list(tg_messages), n),
+        "tg_merge_page": (lambda msgs: app.merge_tg_messages(msgs, tg_page), lambda: list(tg_messages), len(tg_page)),
+        "tg_html_window_cold": (lambda _: app.tg_transcript_segments(tg_messages, app.TG_RENDER_WINDOW), cold_cache, min(n, app.TG_RENDER_WINDOW)),
+        "tg_html_window_warm": (lambda _: app.tg_transcript_segments(tg_messages, app.TG_RENDER_WINDOW), None, min(n, app.TG_RENDER_WINDOW)),
+        "tg_html_full_cold": (lambda _: app.tg_transcript_segments(tg_messages, n), cold_cache, n),
+        "gemini_html_window_cold": (lambda _: gemini_html(messages[-window:]), cold_cache, min(n, window)),
+        "gemini_html_window_warm": (lambda _: gemini_html(messages[-window:]), None, min(n, window)),
+        "gemini_html_full_cold": (lambda _: gemini_html(messages), cold_cache, n),
+        "search_build": (search_index, None, n),
+        "search_query": (lambda _: [index.search(q) for q in ("파이썬 서버", "python cache", "요약 예제")], None, 3),
+    }
+    results = {}
+    for name, (fn, setup, units) in cases.items():
+        median, best, peak = measure(fn, repeat, setup)
+        unit = "MB/s" if name.endswith("_data") else "ops/s"
+        rate = (units / 1e6 if unit == "MB/s" else units) / median if median else None
+        results[name] = {"median_ms": median * 1000, "min_ms": best * 1000, "peak_kb": peak / 1024,
+                         "throughput": rate, "unit": unit}
+        print(f"  {name:<26} {median * 1000:10.2f} ms  {rate or 0:14.1f} {unit:<6} peak {peak / 1024:10.1f} KB", flush=True)
+    return results
+
+
+def compare(old_path, new_path, threshold):
+    """두 결과 파일의 median_ms 비교. threshold 배 이상 느려진 항목이 있으면 종료 코드 1."""
+    with open(old_path, encoding="utf-8") as f: old = json.load(f)["results"]
+    with open(new_path, encoding="utf-8") as f: new = json.load(f)["results"]
+    regressed = False
+    for size in sorted(set(old) & set(new), key=int):
+        print(f"[{size} messages]")
+        for name in sorted(set(old[size]) & set(new[size])):
+            a, b = old[size][name]["median_ms"], new[size][name]["median_ms"]
+            ratio = b / a if a else float("inf")
+            flag = "  REGRESSION" if ratio >= threshold else ""
+            regressed |= bool(flag)
+            print(f"  {name:<26} {a:10.2f} -> {b:10.2f} ms  x{ratio:5.2f}{flag}")
+    return 1 if regressed else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--out", default=None, help="결과 JSON 경로 (기본: bench-<시각>.json)")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"))
+    parser.add_argument("--threshold", type=float, default=1.25, help="--compare 회귀 판정 배율")
+    args = parser.parse_args()
+    if args.compare: sys.exit(compare(*args.compare, args.threshold))
+
+    out = os.path.abspath(args.out or f"bench-{datetime.now():%Y%m%d-%H%M%S}.json")
+    with tempfile.TemporaryDirectory() as workdir:
+        app = load_app(workdir)
+        results = {}
+        for n in args.sizes:
+            print(f"[{n} messages]", flush=True)
+            results[str(n)] = run_size(app, n, max(1, args.repeat if n < 100000 else min(args.repeat, 3)), workdir)
+        app.get_persistence().flush()
+        os.chdir(REPO_DIR)
+    report = {"created": datetime.now().isoformat(timespec="seconds"), "python": platform.python_version(),
+              "platform": platform.platform(), "repeat": args.repeat, "results": results}
+    with open(out, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"saved {out}")
+
+
+if __name__ == "__main__":
+    main()
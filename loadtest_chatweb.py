@@ -0,0 +1,502 @@
+"""personal_chatweb 오프라인 부하 테스트.
+
+로컬 Gemini 모의 서버(/v1beta/models, :generateContent, :streamGenerateContent,
+:countTokens)와 Telethon 호환 가짜 클라이언트를 띄운 뒤, 가상 사용자 여러 명이
+AppTest로 앱을 동시에 돌린다. 동작별 왕복 시간(p50/p95/p99), 초당 rerun 수,
+세션당 메모리를 보고한다. 외부 네트워크나 실제 Telegram 계정이 필요 없다.
+
+    python loadtest_chatweb.py --users 8 --duration 30 --latency 300 --error-rate 0.05
+    python loadtest_chatweb.py --serve --port 8765   # 모의 Gemini 서버만 띄움
+    GEMINI_API_BASE=http://127.0.0.1:8765/v1beta streamlit run personal_chatweb.py
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import platform
+import random
+import re
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import types
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+APP_PATH = os.path.join(REPO_DIR, "personal_chatweb.py")
+MOCK_MODELS = ["gemini-2.5-pro", "gemini-2.5-flash", "gemini-2.0-flash", "gemini-exp-1206"]
+WORDS = ("안녕하세요 오늘 파이썬 서버 설정 방법 요약 예제 데이터 모델 결과 "
+         "hello world python server config deploy stream token model cache latency").split()
+
+
+# --- Gemini 모의 서버 ---
+class MockGemini:
+    """Gemini REST API 흉내. 지연(latency ± jitter), 오류율, 응답 길이를 조절할 수 있다."""
+    def __init__(self, latency=0.3, jitter=0.1, error_rate=0.0, error_status=503, reply_chars=800,
+                 stream_chunks=8, chunk_delay=0.02, seed=0):
+        self.latency, self.jitter = latency, jitter
+        self.error_rate, self.error_status = error_rate, error_status
+        self.reply_chars, self.stream_chunks, self.chunk_delay = reply_chars, stream_chunks, chunk_delay
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.counts = {}  # 엔드포인트 -> 요청 수 ("error"는 주입한 오류 수)
+        self.server = None
+
+    def _count(self, name):
+        with self.lock: self.counts[name] = self.counts.get(name, 0) + 1
+
+    def _sleep(self):
+        with self.lock: delay = max(0.0, self.latency + self.rng.uniform(-self.jitter, self.jitter))
+        time.sleep(delay)
+
+    def _fail(self):
+        with self.lock: return self.rng.random() < self.error_rate
+
+    def reply_text(self, model, prompt):
+        with self.lock: rng = random.Random(self.rng.random())
+        head = f"[{model}] {prompt[:40]} → "
+        words = []
+        while len(head) + sum(len(w) + 1 for w in words) < self.reply_chars: words.append(rng.choice(WORDS))
+        return head + " ".join(words)
+
+    def error_body(self):
+        body = {"error": {"code": self.error_status, "message": "mock overload", "status": "UNAVAILABLE"}}
+        if self.error_status == 429:
+            body["error"]["details"] = [{"@type": "type.googleapis.com/google.rpc.RetryInfo", "retryDelay": "0.2s"}]
+        return body
+
+    def start(self, host="127.0.0.1", port=0):
+        mock = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args): pass
+
+            def _send(self, code, obj):
+                data = json.dumps(obj, ensure_ascii=False).encode("utf-8")
+                self.send_response(code)
+                self.send_header("Content-Type", "application/json; charset=utf-8")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def _route(self):
+                url = urlparse(self.path)
+                if "key" not in parse_qs(url.query):
+                    self._send(403, {"error": {"code": 403, "message": "API key missing", "status": "PERMISSION_DENIED"}})
+                    return None, None
+                return url.path, re.match(r"^/v1beta/models/([^/:]+):(\w+)$", url.path)
+
+            def do_GET(self):
+                path, _ = self._route()
+                if path is None: return
+                if path != "/v1beta/models":
+                    return self._send(404, {"error": {"code": 404, "message": path, "status": "NOT_FOUND"}})
+                mock._count("models")
+                self._send(200, {"models": [{"name": f"models/{m}", "displayName": m.replace("-", " ").title(),
+                                             "supportedGenerationMethods": ["generateContent", "countTokens"]}
+                                            for m in MOCK_MODELS]})
+
+            def do_POST(self):
+                payload = json.loads(self.rfile.read(int(self.headers.get("Content-Length") or 0)) or b"{}")
+                path, match = self._route()
+                if path is None: return
+                if not match:
+                    return self._send(404, {"error": {"code": 404, "message": path, "status": "NOT_FOUND"}})
+                model, method = match.groups()
+                mock._count(method)
+                texts = [p.get("text", "") for c in payload.get("contents", []) for p in c.get("parts", [])]
+                if method == "countTokens":
+                    return self._send(200, {"totalTokens": sum(len(t) for t in texts) // 4 + 1})
+                mock._sleep()
+                if mock._fail():
+                    mock._count("error")
+                    return self._send(mock.error_status, mock.error_body())
+                text = mock.reply_text(model, texts[-1] if texts else "")
+                if method == "generateContent":
+                    return self._send(200, {"candidates": [{"content": {"role": "model", "parts": [{"text": text}]},
+                                                            "finishReason": "STOP"}]})
+                if method != "streamGenerateContent":
+                    return self._send(404, {"error": {"code": 404, "message": method, "status": "NOT_FOUND"}})
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Connection", "close")
+                self.end_headers()
+                step = max(1, -(-len(text) // mock.stream_chunks))
+                for k in range(0, len(text), step):
+                    chunk = {"candidates": [{"content": {"role": "model", "parts": [{"text": text[k:k + step]}]}}]}
+                    self.wfile.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\r\n\r\n".encode("utf-8"))
+                    self.wfile.flush()
+                    time.sleep(mock.chunk_delay)
+                self.close_connection = True
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, name="mock-gemini", daemon=True).start()
+        return f"http://{host}:{self.server.server_port}/v1beta"
+
+    def stop(self):
+        if self.server: self.server.shutdown()
+
+
+# --- Telethon 호환 가짜 클라이언트 ---
+class FakeTelegram:
+    """앱이 쓰는 Telethon API만 흉내 내는 가짜 계정 (모든 클라이언트가 공유).
+
+    대화별 기록을 메모리에 두고, 메시지를 보내면 reply_delay 후 봇 응답을 만들어
+    등록된 NewMessage 핸들러에 전달한다. flood_rate 확률로 조회가 FloodWaitError를 낸다.
+    """
+    latency = 0.05
+    reply_delay = 0.3
+    flood_rate = 0.0
+    history = 200  # 대화를 처음 조회할 때 채워 두는 메시지 수
+    dialogs = {}  # 대화 -> [FakeMessage]
+    clients = []
+    ids = itertools.count(1)  # 사용자 계정의 메시지 id는 대화와 관계없이 하나의 순번
+    lock = threading.Lock()
+    counts = {}
+
+    @classmethod
+    def count(cls, name):
+        with cls.lock: cls.counts[name] = cls.counts.get(name, 0) + 1
+
+    @classmethod
+    def post(cls, dialog, text, out):
+        with cls.lock:
+            msg = FakeMessage(next(cls.ids), text, out)
+            cls.dialogs.setdefault(dialog, []).append(msg)
+        return msg
+
+    @classmethod
+    def messages(cls, dialog):
+        if dialog not in cls.dialogs:
+            for k in range(cls.history): cls.post(dialog, f"{dialog} history {k}", k % 2 == 0)
+        return cls.dialogs[dialog]
+
+
+class FakeMessage:
+    photo = document = file = voice = video = audio = sticker = None
+
+    def __init__(self, msg_id, text, out):
+        self.id, self.text, self.out, self.date = msg_id, text, out, datetime.now()
+
+
+class FakeEvent:
+    def __init__(self, message): self.message = message
+
+
+class FakeEventBuilder:
+    def __init__(self, chats=None): self.chats = chats
+
+
+class FakeNewMessage(FakeEventBuilder): pass
+
+
+class FakeMessageEdited(FakeEventBuilder): pass
+
+
+class FakeFloodWaitError(Exception):
+    def __init__(self, request=None, capture=0):
+        super().__init__(f"A wait of {capture} seconds is required")
+        self.seconds = capture
+
+
+class FakeTelegramClient:
+    def __init__(self, session, api_id, api_hash, **kwargs):
+        self.connected = False
+        self.handlers = []
+        FakeTelegram.clients.append(self)
+
+    async def _rtt(self, name):
+        FakeTelegram.count(name)
+        await asyncio.sleep(FakeTelegram.latency)
+
+    async def connect(self):
+        await self._rtt("connect"); self.connected = True
+
+    def is_connected(self): return self.connected
+
+    async def disconnect(self): self.connected = False
+
+    async def is_user_authorized(self): return True
+
+    async def send_code_request(self, phone): return types.SimpleNamespace(phone_code_hash="fake")
+
+    async def sign_in(self, *args, **kwargs): return None
+
+    async def get_input_entity(self, entity):
+        await self._rtt("get_input_entity"); return entity
+
+    def add_event_handler(self, callback, event):
+        self.handlers.append((callback, event))
+
+    async def iter_messages(self, entity, limit=None, min_id=0, offset_id=0, reverse=False):
+        await self._rtt("iter_messages")
+        if random.random() < FakeTelegram.flood_rate: raise FakeFloodWaitError(capture=1)
+        msgs = [m for m in FakeTelegram.messages(entity) if m.id > min_id and (not offset_id or m.id < offset_id)]
+        if not reverse: msgs.reverse()
+        for msg in msgs[:limit] if limit else msgs: yield msg
+
+    async def get_messages(self, entity, ids=None):
+        await self._rtt("get_messages")
+        wanted = set(ids or ())
+        return [m for m in FakeTelegram.messages(entity) if m.id in wanted]
+
+    async def send_message(self, entity, text):
+        await self._rtt("send_message")
+        FakeTelegram.messages(entity)
+        msg = FakeTelegram.post(entity, text, True)
+        asyncio.get_running_loop().create_task(self._bot_reply(entity, text))
+        return msg
+
+    async def _bot_reply(self, entity, text):
+        await asyncio.sleep(FakeTelegram.reply_delay)
+        msg = FakeTelegram.post(entity, f"echo: {text}", False)
+        for client in list(FakeTelegram.clients):
+            for callback, event in client.handlers:
+                if isinstance(event, FakeNewMessage) and event.chats == entity: await callback(FakeEvent(msg))
+
+    async def download_media(self, msg, file=None, thumb=None): return None
+
+
+
+def install_fake_telethon():
+    """sys.modules의 telethon을 가짜로 바꾼다. 앱은 telethon을 함수 안에서 import하므로 이것만으로 연결된다."""
+    telethon = types.ModuleType("telethon")
+    events = types.ModuleType("telethon.events")
+    errors = types.ModuleType("telethon.errors")
+    telethon.TelegramClient = FakeTelegramClient
+    events.NewMessage, events.MessageEdited = FakeNewMessage, FakeMessageEdited
+    errors.FloodWaitError = FakeFloodWaitError
+    telethon.events, telethon.errors = events, errors
+    sys.modules.update({"telethon": telethon, "telethon.events": events, "telethon.errors": errors})
+
+
+# --- 가상 사용자 ---
+def patch_apptest_for_threads():
+    """AppTest를 여러 스레드에서 동시에 돌릴 수 있게 한다 (실제 서버의 한 프로세스·여러 세션과 같은 모양).
+
+    - 실행마다 만드는 ScriptCache를 하나로 공유: 스크립트를 한 번만 컴파일한다 (서버와 동일).
+      동시에 compile()하면 CPython 3.11에서 AST 오류가 나기도 한다.
+    - 실행이 끝날 때 Runtime._instance = None으로 지우는 것을 무시: 다른 스레드의 실행이 깨지지 않게.
+    """
+    from streamlit.runtime import Runtime
+    from streamlit.runtime.scriptrunner.script_cache import ScriptCache
+    from streamlit.testing.v1 import app_test, local_script_runner
+
+    class _KeepInstance(type):
+        def __setattr__(cls, name, value):
+            if name == "_instance" and value is None: return
+            setattr(Runtime, name, value)
+
+    class SharedRuntime(Runtime, metaclass=_KeepInstance): pass
+
+    shared = ScriptCache()
+    app_test.ScriptCache = local_script_runner.ScriptCache = lambda: shared
+    app_test.Runtime = SharedRuntime
+
+
+def app_password():
+    with open(APP_PATH, encoding="utf-8") as f:
+        return re.search(r'^ACCESS_PASSWORD = "(.*?)"', f.read(), re.M).group(1)
+
+
+class SimUser:
+    """브라우저 세션 하나. AppTest로 로그인·설정한 뒤 무작위 동작을 반복한다."""
+    def __init__(self, n, args, password):
+        self.n, self.args, self.password = n, args, password
+        self.rng = random.Random(args.seed + n)
+        self.samples = []  # (동작, 초, 성공 여부)
+        self.runs = 0
+        self.at = None
+
+    def run(self, action=None):
+        t0 = time.perf_counter()
+        self.at.run(timeout=self.args.timeout)
+        elapsed = time.perf_counter() - t0
+        self.runs += 1
+        if action:
+            failed = self.at.exception or any(re.search(r"error|exception|failed", e.value, re.I) for e in self.at.error)
+            self.samples.append((action, elapsed, not failed))
+        return elapsed
+
+    def setup(self):
+        from streamlit.testing.v1 import AppTest
+        self.at = AppTest.from_file(APP_PATH, default_timeout=self.args.timeout)
+        self.run()
+        self.at.text_input[0].input(self.password)
+        self.at.button[0].click()
+        self.run("login")
+        next(t for t in self.at.text_input if t.label == "API Key").input(f"mock-key-{self.n}")
+        self.run("setup")
+        if self.args.bots:
+            for key, value in dict(sb_tid="1", sb_thash="fake", sb_tphone="+10000000000", sb_tbot=self.args.bots).items():
+                self.at.text_input(key=key).input(value)
+            self.run("setup")
+            self.at.button(key="sb_tconnect").click()
+            self.run("setup")
+
+    def step(self):
+        r = self.rng.random()
+        if r < self.args.p_gemini:
+            self.at.session_state["main_tabs"] = next(t.label for t in self.at.tabs if t.label != "📱 Telegram")
+            self.run()
+            chat = next(c for c in self.at.chat_input if c.key.startswith("input_"))
+            chat.set_value(f"user {self.n}: {self.rng.choice(WORDS)} {self.rng.randint(0, 9999)}")
+            self.run("gemini")
+        elif self.args.bots and r < self.args.p_gemini + self.args.p_telegram:
+            self.at.session_state["main_tabs"] = "📱 Telegram"
+            self.run()
+            chat = next((c for c in self.at.chat_input if c.key.startswith("tg_input_")), None)
+            if chat is None: return self.run("telegram")
+            chat.set_value(f"ping {self.n} {self.rng.randint(0, 9999)}")
+            self.run("telegram")
+        else:
+            self.run("rerun")
+        if self.args.think: time.sleep(self.rng.uniform(0, self.args.think))
+
+    def loop(self, deadline):
+        while time.monotonic() < deadline:
+            try:
+                self.step()
+            except Exception as e:
+                self.samples.append(("driver_error", 0.0, False))
+                print(f"  user {self.n}: {type(e).__name__}: {e}", file=sys.stderr, flush=True)
+
+
+def percentiles(values):
+    if not values: return {"p50": None, "p95": None, "p99": None}
+    if len(values) == 1: return {k: values[0] * 1000 for k in ("p50", "p95", "p99")}
+    q = statistics.quantiles(values, n=100, method="inclusive")
+    return {"p50": q[49] * 1000, "p95": q[94] * 1000, "p99": q[98] * 1000}
+
+
+def rss_kb():
+    """현재 RSS (KB). /proc이 없으면 최대 RSS로 대신한다."""
+    try:
+        with open("/proc/self/status") as f:
+            return int(next(line for line in f if line.startswith("VmRSS:")).split()[1])
+    except (OSError, StopIteration):
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak // 1024 if sys.platform == "darwin" else peak
+
+
+def drive(args):
+    mock = MockGemini(args.latency / 1000, args.jitter / 1000, args.error_rate, args.error_status,
+                      args.reply_chars, args.stream_chunks, args.chunk_delay / 1000, args.seed)
+    os.environ["GEMINI_API_BASE"] = mock.start()
+    if args.bots:
+        install_fake_telethon()
+        FakeTelegram.latency, FakeTelegram.reply_delay = args.tg_latency / 1000, args.tg_reply_delay / 1000
+        FakeTelegram.flood_rate = args.tg_flood_rate
+    import streamlit.logger
+    patch_apptest_for_threads()
+    password = app_password()
+    users = [SimUser(n, args, password) for n in range(args.users)]
+    with tempfile.TemporaryDirectory() as workdir:
+        os.chdir(workdir)
+        # 세션당 메모리: 첫 사용자(모듈·공유 객체 초기화 포함) 이후 추가 세션마다 늘어난 파이썬 힙
+        print(f"setting up {args.users} sessions...", flush=True)
+        users[0].setup()
+        streamlit.logger.set_log_level("error")
+        rss0 = rss_kb()
+        tracemalloc.start()
+        base = tracemalloc.get_traced_memory()[0]
+        for user in users[1:]: user.setup()
+        heap = tracemalloc.get_traced_memory()[0] - base
+        tracemalloc.stop()
+        per_session_kb = heap / 1024 / max(1, args.users - 1) if args.users > 1 else None
+        rss_per_session_kb = (rss_kb() - rss0) / (args.users - 1) if args.users > 1 else None
+        for user in users: user.samples.clear(); user.runs = 0
+
+        print(f"running for {args.duration}s...", flush=True)
+        deadline = time.monotonic() + args.duration
+        t0 = time.perf_counter()
+        threads = [threading.Thread(target=u.loop, args=(deadline,), name=f"sim-user-{u.n}") for u in users]
+        for t in threads: t.start()
+        for t in threads: t.join()
+        wall = time.perf_counter() - t0
+        os.chdir(REPO_DIR)
+    mock.stop()
+
+    samples = [s for u in users for s in u.samples]
+    actions = {}
+    for name in sorted({a for a, _, _ in samples}):
+        times = [t for a, t, _ in samples if a == name]
+        actions[name] = dict(percentiles(times), n=len(times), errors=sum(1 for a, _, ok in samples if a == name and not ok))
+    return {
+        "created": datetime.now().isoformat(timespec="seconds"), "python": platform.python_version(),
+        "platform": platform.platform(), "config": vars(args), "wall_s": wall,
+        "reruns": sum(u.runs for u in users), "reruns_per_s": sum(u.runs for u in users) / wall,
+        "overall": percentiles([t for a, t, _ in samples if a != "driver_error"]),
+        "actions": actions, "memory_per_session_kb": per_session_kb, "rss_per_session_kb": rss_per_session_kb,
+        "rss_kb": rss_kb(), "gemini_requests": dict(mock.counts), "telegram_requests": dict(FakeTelegram.counts),
+    }
+
+
+def print_report(report):
+    fmt = lambda v: f"{v:9.1f}" if v is not None else f"{'-':>9}"
+    print(f"{'action':<14}{'n':>7}{'err':>6}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for name, a in report["actions"].items():
+        print(f"{name:<14}{a['n']:>7}{a['errors']:>6} {fmt(a['p50'])} {fmt(a['p95'])} {fmt(a['p99'])}")
+    o = report["overall"]
+    print(f"{'all':<14}{'':>13} {fmt(o['p50'])} {fmt(o['p95'])} {fmt(o['p99'])}")
+    print(f"reruns: {report['reruns']} in {report['wall_s']:.1f}s = {report['reruns_per_s']:.1f}/s")
+    if report["memory_per_session_kb"] is not None:
+        print(f"memory per session: {report['memory_per_session_kb']:.0f} KB heap · {report['rss_per_session_kb']:.0f} KB RSS"
+              f" (total RSS {report['rss_kb'] / 1024:.0f} MB)")
+    print(f"gemini: {report['gemini_requests']}  telegram: {report['telegram_requests']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=4, help="동시 가상 사용자(브라우저 세션) 수")
+    parser.add_argument("--duration", type=float, default=20, help="부하 구간 (초)")
+    parser.add_argument("--think", type=float, default=0.0, help="동작 사이 최대 대기 (초, 균등 분포)")
+    parser.add_argument("--p-gemini", type=float, default=0.4, help="동작 중 Gemini 메시지 전송 비율")
+    parser.add_argument("--p-telegram", type=float, default=0.2, help="동작 중 Telegram 메시지 전송 비율 (나머지는 단순 rerun)")
+    parser.add_argument("--bots", default="@load_bot_a, @load_bot_b", help="가짜 Telegram 대화 목록 (빈 문자열이면 Telegram 없이)")
+    parser.add_argument("--latency", type=float, default=300, help="Gemini 응답 지연 (ms)")
+    parser.add_argument("--jitter", type=float, default=100, help="지연 ± 범위 (ms)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Gemini 오류 응답 비율 (0~1)")
+    parser.add_argument("--error-status", type=int, default=503, help="주입할 오류 상태 코드 (429면 RetryInfo 포함)")
+    parser.add_argument("--reply-chars", type=int, default=800, help="Gemini 응답 길이 (문자)")
+    parser.add_argument("--stream-chunks", type=int, default=8, help="스트리밍 응답 청크 수")
+    parser.add_argument("--chunk-delay", type=float, default=20, help="스트리밍 청크 간격 (ms)")
+    parser.add_argument("--tg-latency", type=float, default=50, help="가짜 Telegram 왕복 지연 (ms)")
+    parser.add_argument("--tg-reply-delay", type=float, default=300, help="가짜 봇 응답 지연 (ms)")
+    parser.add_argument("--tg-flood-rate", type=float, default=0.0, help="기록 조회가 FloodWait(1초)를 낼 비율")
+    parser.add_argument("--timeout", type=float, default=60, help="rerun 1회 제한 시간 (초)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", default=None, help="결과 JSON 경로")
+    parser.add_argument("--serve", action="store_true", help="부하 없이 모의 Gemini 서버만 실행")
+    parser.add_argument("--port", type=int, default=8765, help="--serve 포트")
+    args = parser.parse_args()
+
+    if args.serve:
+        mock = MockGemini(args.latency / 1000, args.jitter / 1000, args.error_rate, args.error_status,
+                          args.reply_chars, args.stream_chunks, args.chunk_delay / 1000, args.seed)
+        print(f"GEMINI_API_BASE={mock.start(port=args.port)}", flush=True)
+        try:
+            while True: time.sleep(3600)
+        except KeyboardInterrupt:
+            mock.stop(); return
+
+    report = drive(args)
+    print_report(report)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"saved {os.path.abspath(args.out)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -4,9 +4,25 @@ import json
 import uuid
 import os
 import base64
+import hashlib
 import asyncio
 import threading
 import time
+import queue
+import weakref
+import random
+import re
+import math
+import heapq
+import bisect
+from array import array
+import atexit
+import collections
+import zlib
+import contextlib
+import tempfile
+from email.utils import parsedate_to_datetime
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
 
 # ==========================================
@@ -14,7 +30,44 @@ from datetime import datetime
 # ==========================================
 ACCESS_PASSWORD = "1111"  # TODO: st.secrets 또는 환경변수로 이동 권장
 HISTORY_FILE = "system_log.dat"
-TELEGRAM_HISTORY_FILE = "telegram_log.dat"
+HISTORY_JOURNAL_FILE = "system_log.journal"
+JOURNAL_COMPACT_EVERY = 200  # 저널 레코드가 이만큼 쌓이면 스냅샷으로 압축
+SEARCH_INDEX_FILE = "search_index.dat"
+SEARCH_JOURNAL_FILE = "search_index.journal"
+SEARCH_RESULT_LIMIT = 20
+PERSIST_DEBOUNCE = 0.5  # 초 — 이 안에 들어온 저장 요청은 한 번의 쓰기로 합침
+SESSIONS_DIR = "system_sessions"  # 세션별 샤드 + index.dat
+ARCHIVE_DIR = os.path.join(SESSIONS_DIR, "archive")  # 오래 안 쓴 세션 (zlib 압축 + 암호화)
+ARCHIVE_IDLE_DAYS = 21  # 마지막 활동 후 이만큼 지나면 시작 시 자동 보관
+TELEGRAM_HISTORY_FILE = "telegram_log.dat"  # 대화별 기록 이전의 단일 기록 (첫 대화가 가져감)
+TELEGRAM_JOURNAL_FILE = "telegram_log.journal"
+TELEGRAM_DIALOG_DIR = "telegram_dialogs"  # 대화(봇)별 기록: <대화>.dat + .journal
+TG_FETCH_CONCURRENCY = 4  # 새로고침 시 연결 하나로 동시에 조회하는 대화 수
+TG_FLOOD_WAIT_MAX = 10  # 초 — FloodWait가 이 이하면 기다렸다 재시도, 넘으면 그 대화는 실패 처리
+TG_PAGE_SIZE = 100  # 첫 동기화 / 이전 기록 불러오기 1회 분량
+TG_MEDIA_DIR = "tg_media"  # 첨부 파일·썸네일 캐시 (암호화)
+TG_MEDIA_CACHE_BYTES = 512 << 20  # 넘으면 오래 안 쓴 파일부터 삭제
+TG_MEDIA_MAX_FILE = 50 << 20  # 이보다 큰 첨부는 썸네일만 받음
+TG_MEDIA_CONCURRENCY = 3  # 동시 다운로드 수
+TG_THUMB_SIZE = 320  # px
+MODEL_CACHE_FILE = "model_cache.dat"
+MODEL_CACHE_TTL = 6 * 3600  # 초 — 지나면 캐시를 쓰면서 백그라운드로 갱신
+RESPONSE_CACHE_FILE = "response_cache.dat"  # temperature 0 + 검색 없음 요청의 응답 캐시
+RESPONSE_CACHE_MAX_ENTRIES = 500
+RESPONSE_CACHE_MAX_BYTES = 8 << 20  # 응답 텍스트 합계 상한
+RESPONSE_CACHE_TTL = 7 * 24 * 3600  # 초
+CONTEXT_TOKEN_BUDGETS = [("flash-lite", 16000), ("flash", 32000), ("pro", 64000)]  # 모델 id 부분 문자열 → 토큰 예산
+CONTEXT_DEFAULT_BUDGET = 32000
+SUMMARY_MODEL = "gemini-2.5-flash"  # 롤링 요약용
+SUMMARY_REFRESH_EVERY = 6  # 요약 밖으로 밀려난 메시지가 이만큼 쌓이면 요약 갱신
+SUMMARY_INPUT_BUDGET = 16000  # 요약 1회에 넣는 최대 토큰
+GEMINI_RENDER_WINDOW = 40  # 탭마다 처음 렌더링하는 최근 메시지 수
+GEMINI_RENDER_PAGE = 40  # "Load older" 1회에 늘리는 수
+TG_RENDER_WINDOW = 200  # Telegram 탭에 처음 렌더링하는 최근 메시지 수
+FANOUT_MAX_WORKERS = 4  # 멀티 모델 동시 요청 수 상한
+RENDER_CACHE_SIZE = 5000  # 캐시할 HTML 조각 수 (프로세스 전체)
+METRICS_RING_SIZE = 1000  # span 이름별로 보관하는 최근 측정 수
+METRICS_FILE = "metrics.jsonl"  # 성능 패널에서 켜면 span을 한 줄씩 추가 (오프라인 분석용)
 
 # --- 1. 페이지 설정 ---
 st.set_page_config(
@@ -25,28 +78,190 @@ st.set_page_config(
 )
 
 # --- 2. 유틸리티 함수 ---
-def encrypt_data(data_str, key):
-    enc = []
-    for i, c in enumerate(data_str):
+# --- 계측 ---
+class Metrics:
+    """프로세스 공유 timing span 링 버퍼 (span 이름별 최근 N개).
+
+    with get_metrics().span("store.load"): ... 형태로 감싸면 소요 시간이 기록된다.
+    path가 설정되어 있으면 span마다 JSONL 한 줄을 추가한다.
+    """
+    def __init__(self, size=METRICS_RING_SIZE):
+        self.size = size
+        self.spans = {}  # name -> deque[초]
+        self.path = None
+        self.lock = threading.Lock()
+
+    def record(self, name, seconds, **attrs):
+        with self.lock:
+            ring = self.spans.get(name)
+            if ring is None: ring = self.spans[name] = collections.deque(maxlen=self.size)
+            ring.append(seconds)
+            if self.path:
+                try:
+                    with open(self.path, "a", encoding="utf-8") as f:
+                        f.write(json.dumps(dict(attrs, ts=round(time.time(), 3), span=name, ms=round(seconds * 1000, 3)), ensure_ascii=False) + "\n")
+                except OSError: pass
+
+    @contextlib.contextmanager
+    def span(self, name, **attrs):
+        start = time.perf_counter()
+        try: yield
+        finally: self.record(name, time.perf_counter() - start, **attrs)
+
+    def summary(self):
+        """[(name, 건수, p50, p95, p99, max)] — 밀리초, p95 내림차순"""
+        with self.lock:
+            snapshot = {name: sorted(ring) for name, ring in self.spans.items() if ring}
+        rows = []
+        for name, values in snapshot.items():
+            pct = lambda q: values[min(len(values) - 1, int(len(values) * q))] * 1000
+            rows.append((name, len(values), pct(0.5), pct(0.95), pct(0.99), values[-1] * 1000))
+        return sorted(rows, key=lambda r: -r[3])
+
+    def reset(self):
+        with self.lock: self.spans.clear()
+
+@st.cache_resource
+def get_metrics():
+    return Metrics()
+
+# 저장 포맷 v2: "v2:" + base64(nonce + ciphertext)
+# SHAKE-256 키스트림을 청크 단위로 생성해 UTF-8 바이트에 일괄 XOR 한다.
+# 접두사가 없는 데이터는 v1(문자 단위 XOR) 포맷으로 보고 읽기만 지원한다.
+CIPHER_PREFIX = "v2:"
+CIPHER_NONCE_SIZE = 16
+CIPHER_CHUNK_SIZE = 1 << 20  # 1 MiB
+
+def _keystream(key_bytes, nonce, index, size):
+    return hashlib.shake_256(key_bytes + nonce + index.to_bytes(8, "big")).digest(size)
+
+def _xor_bytes(data, stream):
+    # 정수 XOR 한 번으로 청크 전체를 처리 (C 레벨 연산)
+    return (int.from_bytes(data, "little") ^ int.from_bytes(stream, "little")).to_bytes(len(data), "little")
+
+def iter_cipher_chunks(data, key, nonce, chunk_size=CIPHER_CHUNK_SIZE):
+    """data를 chunk_size 단위로 암/복호화해 순서대로 yield (XOR이라 양방향 동일)"""
+    key_bytes = key.encode("utf-8")
+    for index, start in enumerate(range(0, len(data), chunk_size)):
+        chunk = data[start:start + chunk_size]
+        yield _xor_bytes(chunk, _keystream(key_bytes, nonce, index, len(chunk)))
+
+def encrypt_bytes(data, key):
+    nonce = os.urandom(CIPHER_NONCE_SIZE)
+    return nonce + b"".join(iter_cipher_chunks(data, key, nonce))
+
+def decrypt_bytes(blob, key):
+    nonce, body = blob[:CIPHER_NONCE_SIZE], blob[CIPHER_NONCE_SIZE:]
+    return b"".join(iter_cipher_chunks(body, key, nonce))
+
+def _decrypt_legacy(enc_str, key):
+    """v1 포맷 (문자 단위 XOR) — 기존 .dat 파일 마이그레이션 전용"""
+    dec = []
+    enc_str = base64.b64decode(enc_str).decode()
+    for i, c in enumerate(enc_str):
         key_c = key[i % len(key)]
-        enc.append(chr(ord(c) ^ ord(key_c)))
-    return base64.b64encode("".join(enc).encode()).decode()
+        dec.append(chr(ord(c) ^ ord(key_c)))
+    return "".join(dec)
+
+def is_legacy_cipher(enc_str):
+    return not enc_str.startswith(CIPHER_PREFIX)
+
+def encrypt_data(data_str, key):
+    with get_metrics().span("crypto.encrypt"):
+        return CIPHER_PREFIX + base64.b64encode(encrypt_bytes(data_str.encode("utf-8"), key)).decode()
 
 def decrypt_data(enc_str, key):
     try:
-        dec = []
-        enc_str = base64.b64decode(enc_str).decode()
-        for i, c in enumerate(enc_str):
-            key_c = key[i % len(key)]
-            dec.append(chr(ord(c) ^ ord(key_c)))
-        return "".join(dec)
+        with get_metrics().span("crypto.decrypt"):
+            if is_legacy_cipher(enc_str):
+                return _decrypt_legacy(enc_str, key)
+            return decrypt_bytes(base64.b64decode(enc_str[len(CIPHER_PREFIX):]), key).decode("utf-8")
     except:
         return ""
 
-def fetch_available_models(api_key):
-    url = f"https://generativelanguage.googleapis.com/v1beta/models?key={api_key}"
+# --- Gemini HTTP 클라이언트 ---
+# 부하 테스트(loadtest_chatweb.py)는 환경변수로 로컬 모의 서버를 가리킨다
+GEMINI_API_BASE = os.environ.get("GEMINI_API_BASE", "https://generativelanguage.googleapis.com/v1beta")
+GEMINI_TIMEOUT = (5, 180)  # (connect, read) 초 — read는 바이트 간 최대 대기
+GEMINI_MAX_RETRIES = 3
+GEMINI_RETRY_STATUS = {429, 500, 502, 503, 504}
+GEMINI_BACKOFF_BASE = 1.0
+GEMINI_BACKOFF_CAP = 20.0
+
+class GeminiClient:
+    """프로세스 전체에서 공유하는 Gemini HTTP 클라이언트.
+
+    keep-alive 커넥션 풀을 재사용하고, 모든 요청에 timeout을 건다.
+    429/5xx와 연결 오류는 Retry-After(또는 RetryInfo)를 우선 따르고,
+    없으면 jitter를 준 지수 백오프로 재시도한다.
+    """
+    def __init__(self, pool_size=8):
+        self.session = requests.Session()
+        self.session.mount("https://", requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size))
+        self.session.headers["Content-Type"] = "application/json"
+        self.latencies = collections.deque(maxlen=500)  # (path, status, 초)
+        self.lock = threading.Lock()
+
+    def _backoff(self, attempt):
+        return random.uniform(0, min(GEMINI_BACKOFF_CAP, GEMINI_BACKOFF_BASE * 2 ** attempt))
+
+    def _retry_after(self, res):
+        value = res.headers.get("Retry-After")
+        try:
+            if value:
+                if value.isdigit(): return float(value)
+                return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+            # Gemini는 429 본문의 RetryInfo.retryDelay("23s")로 알려주기도 함
+            for d in res.json().get("error", {}).get("details", []):
+                if d.get("@type", "").endswith("RetryInfo"):
+                    return float(d["retryDelay"].rstrip("s"))
+        except: pass
+        return None
+
+    def request(self, method, path, api_key, payload=None, params=None, stream=False):
+        params = dict(params or {}, key=api_key)
+        data = json.dumps(payload) if payload is not None else None
+        for attempt in range(GEMINI_MAX_RETRIES + 1):
+            start = time.perf_counter()
+            try:
+                res = self.session.request(method, f"{GEMINI_API_BASE}/{path}", params=params, data=data,
+                                           stream=stream, timeout=GEMINI_TIMEOUT)
+            except requests.ConnectionError:
+                # ConnectTimeout 포함. ReadTimeout은 재시도하지 않는다 — 요청은 이미 처리 중이라
+                # 다시 보내면 생성이 새로 과금되고, read 타임아웃만큼 또 기다리게 된다
+                if attempt == GEMINI_MAX_RETRIES: raise
+                time.sleep(self._backoff(attempt)); continue
+            # 스트리밍은 헤더 도착까지(TTFB), 일반 요청은 본문 수신까지의 시간
+            elapsed = time.perf_counter() - start
+            with self.lock:
+                self.latencies.append((path, res.status_code, elapsed))
+            get_metrics().record(f"gemini.{path.rsplit(':', 1)[-1] if ':' in path else path.split('/')[0]}", elapsed, status=res.status_code)
+            if res.status_code not in GEMINI_RETRY_STATUS or attempt == GEMINI_MAX_RETRIES:
+                return res
+            delay = self._retry_after(res)
+            res.close()
+            time.sleep(min(GEMINI_BACKOFF_CAP, delay) if delay is not None else self._backoff(attempt))
+
+    def get(self, path, api_key, **kwargs):
+        return self.request("GET", path, api_key, **kwargs)
+
+    def post(self, path, api_key, payload, **kwargs):
+        return self.request("POST", path, api_key, payload=payload, **kwargs)
+
+    def latency_summary(self):
+        """최근 요청의 (건수, p50, p95) — 초 단위"""
+        with self.lock:
+            values = sorted(v for _, _, v in self.latencies)
+        if not values: return (0, 0.0, 0.0)
+        return (len(values), values[len(values) // 2], values[min(len(values) - 1, int(len(values) * 0.95))])
+
+@st.cache_resource
+def get_gemini_client():
+    return GeminiClient()
+
+def _fetch_models_remote(api_key):
     try:
-        res = requests.get(url)
+        res = get_gemini_client().get("models", api_key)
         if res.status_code == 200:
             models_data = res.json().get("models", [])
             filtered_models = [m for m in models_data if "generateContent" in m.get("supportedGenerationMethods", [])]
@@ -67,107 +282,754 @@ def fetch_available_models(api_key):
     except:
         return None
 
+class ModelCatalogCache:
+    """API 키 지문별 모델 목록 캐시. 암호화 파일로 저장되어 브라우저 세션·재시작 간에 공유된다."""
+    def __init__(self, path=MODEL_CACHE_FILE, ttl=MODEL_CACHE_TTL):
+        self.path = path
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = _load_encrypted_json(path, {})
+        self.refreshing = set()
+
+    @staticmethod
+    def fingerprint(api_key):
+        return hashlib.sha256(api_key.encode("utf-8")).hexdigest()[:16]
+
+    def get(self, api_key):
+        """(models, fresh) — 캐시에 없으면 (None, False)"""
+        entry = self.entries.get(self.fingerprint(api_key))
+        if not entry: return None, False
+        return entry["models"], time.time() - entry["ts"] < self.ttl
+
+    def put(self, api_key, models):
+        with self.lock:
+            self.entries[self.fingerprint(api_key)] = {"ts": time.time(), "models": models}
+            _atomic_write(self.path, encrypt_data(json.dumps(self.entries, ensure_ascii=False), ACCESS_PASSWORD))
+
+    def refresh_async(self, api_key):
+        fp = self.fingerprint(api_key)
+        with self.lock:
+            if fp in self.refreshing: return
+            self.refreshing.add(fp)
+        def _refresh():
+            try:
+                models = _fetch_models_remote(api_key)
+                if models: self.put(api_key, models)
+            finally:
+                self.refreshing.discard(fp)
+        threading.Thread(target=_refresh, daemon=True).start()
+
+@st.cache_resource
+def get_model_cache():
+    return ModelCatalogCache()
+
+def fetch_available_models(api_key, force=False):
+    """캐시 우선. 만료된 항목은 그대로 반환하고 백그라운드에서 갱신, force면 바로 다시 받는다."""
+    cache = get_model_cache()
+    if not force:
+        models, fresh = cache.get(api_key)
+        if models is not None:
+            if not fresh: cache.refresh_async(api_key)
+            return models
+    models = _fetch_models_remote(api_key)
+    if models: cache.put(api_key, models)
+    return models
+
+def gemini_candidate_text(cand):
+    # thought 파트(추론 요약)는 본문에서 제외
+    return "".join(p.get("text", "") for p in cand.get("content", {}).get("parts", []) if not p.get("thought"))
+
+def gemini_candidate_sources(cand):
+    return [c["web"] for c in cand.get("groundingMetadata", {}).get("groundingChunks", []) if "web" in c]
+
+def iter_gemini_stream(res):
+    """streamGenerateContent?alt=sse 응답에서 첫 번째 candidate를 청크 단위로 yield"""
+    for raw in res.iter_lines():
+        # text/event-stream은 charset이 없어 requests가 latin-1로 추측하므로 직접 디코딩
+        line = raw.decode("utf-8")
+        if not line.startswith("data:"): continue
+        chunk = json.loads(line[5:].strip())
+        for cand in chunk.get("candidates", [])[:1]:
+            yield cand
+
+def gemini_generate(client, model_id, api_key, payload):
+    """generateContent 1건 → (text, sources, error, 소요 초). st 호출이 없어 작업 스레드에서 불러도 된다."""
+    start = time.perf_counter()
+    try:
+        res = client.post(f"models/{model_id}:generateContent", api_key, payload)
+        if res.status_code != 200:
+            err = res.json().get("error",{}).get("message","Unknown")
+            return "", [], f"Error {res.status_code}: {err}", time.perf_counter() - start
+        cands = res.json().get("candidates", [])
+        text = gemini_candidate_text(cands[0]) if cands else ""
+        sources = gemini_candidate_sources(cands[0]) if cands else []
+        elapsed = time.perf_counter() - start
+        get_metrics().record("gemini.reply", elapsed, model=model_id)
+        return text, sources, None if text else "No response", elapsed
+    except Exception as e:
+        return "", [], f"Exception: {str(e)}", time.perf_counter() - start
+
+# --- 응답 캐시 ---
+class ResponseCache:
+    """결정적 요청(temperature 0, tools 없음)의 응답 LRU 캐시 (프로세스 공유, 암호화 파일).
+
+    키는 모델 id + 정규화한 payload(JSON, 키 정렬)의 SHA-256. 항목 수·텍스트 크기·나이로 제거한다.
+    """
+    def __init__(self, path=RESPONSE_CACHE_FILE, max_entries=RESPONSE_CACHE_MAX_ENTRIES,
+                 max_bytes=RESPONSE_CACHE_MAX_BYTES, ttl=RESPONSE_CACHE_TTL):
+        self.path = path
+        self.max_entries, self.max_bytes, self.ttl = max_entries, max_bytes, ttl
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict(_load_encrypted_json(path, {}))  # 오래 안 쓴 것부터
+        self.bytes = sum(e["size"] for e in self.entries.values())
+        self.hits = self.misses = 0
+
+    @staticmethod
+    def cacheable(payload):
+        return payload.get("generationConfig", {}).get("temperature") == 0 and not payload.get("tools")
+
+    @staticmethod
+    def key(model_id, payload):
+        canonical = json.dumps({"model": model_id, "payload": payload}, sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+        return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+    def _evict(self):
+        now = time.time()
+        while self.entries:
+            k, e = next(iter(self.entries.items()))
+            if len(self.entries) <= self.max_entries and self.bytes <= self.max_bytes and now - e["ts"] < self.ttl: break
+            self.bytes -= e["size"]; del self.entries[k]
+
+    def _save(self):
+        schedule_encrypted_json(self.path, lambda: self._snapshot())
+
+    def _snapshot(self):
+        with self.lock: return dict(self.entries)
+
+    def get(self, model_id, payload):
+        k = self.key(model_id, payload)
+        with self.lock:
+            entry = self.entries.get(k)
+            if entry and time.time() - entry["ts"] >= self.ttl:
+                self.bytes -= entry["size"]; del self.entries[k]; entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(k)
+            self.hits += 1
+            return entry
+
+    def put(self, model_id, payload, text, sources):
+        k = self.key(model_id, payload)
+        size = len(text.encode("utf-8"))
+        with self.lock:
+            if k in self.entries: self.bytes -= self.entries.pop(k)["size"]
+            self.entries[k] = {"ts": time.time(), "text": text, "sources": sources, "size": size}
+            self.bytes += size
+            self._evict()
+        self._save()
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear(); self.bytes = 0; self.hits = self.misses = 0
+        self._save()
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hits / total if total else 0.0,
+                "entries": len(self.entries), "bytes": self.bytes}
+
+@st.cache_resource
+def get_response_cache():
+    return ResponseCache()
+
+# --- 컨텍스트 구성 (토큰 예산) ---
+def estimate_tokens(text):
+    """로컬 토큰 추정: ASCII는 4자당 1, 한글 등 멀티바이트 문자는 1자당 1"""
+    non_ascii = (len(text.encode("utf-8")) - len(text)) // 2
+    return (len(text) - non_ascii) // 4 + non_ascii + 1
+
+def message_tokens(msg):
+    # 저장된 메시지에 없으면 한 번 계산해 메시지에 붙여 둔다
+    if "tokens" not in msg: msg["tokens"] = estimate_tokens(msg["content"])
+    return msg["tokens"]
+
+def context_budget(model_id):
+    return next((budget for key, budget in CONTEXT_TOKEN_BUDGETS if key in model_id), CONTEXT_DEFAULT_BUDGET)
+
+def _tail_within(messages, end, budget, scale=1.0, start=0):
+    """messages[start:end] 중 뒤에서부터 예산 안에 드는 시작 인덱스 (마지막 메시지는 항상 포함).
+    맥락에서 빠지는 멀티 모델 응답(첫 응답 외)은 예산에 세지 않는다."""
+    used, i = 0.0, end
+    while i > start:
+        cost = 0 if _is_fanout_sibling(messages, i - 1) else message_tokens(messages[i - 1]) * scale
+        if used + cost > budget and i < end: break
+        used += cost; i -= 1
+    return i
+
+def _is_fanout_sibling(messages, k):
+    # 멀티 모델 응답 묶음에서는 첫 응답만 이후 대화 맥락으로 쓴다
+    fanout = messages[k].get("fanout")
+    return bool(fanout) and k > 0 and messages[k - 1].get("fanout") == fanout
+
+def build_context(messages, budget, scale=1.0):
+    """최근 메시지부터 예산이 허락하는 만큼 채운 contents와, 잘려 나간 앞부분의 길이(cut) 반환"""
+    cut = _tail_within(messages, len(messages), budget, scale)
+    contents = [{"role": "user" if m["role"]=="user" else "model", "parts": [{"text": m["content"]}]}
+                for k, m in enumerate(messages[cut:], cut) if not _is_fanout_sibling(messages, k)]
+    return contents, cut
+
+def count_tokens_remote(model_id, api_key, contents):
+    try:
+        res = get_gemini_client().post(f"models/{model_id}:countTokens", api_key, {"contents": contents})
+        if res.status_code == 200: return res.json().get("totalTokens")
+    except: pass
+    return None
+
+def summarize_older(summary, messages, cut, api_key):
+    """messages[:cut]의 롤링 요약. 캐시된 요약({"upto", "text"})을 이어서 갱신하고 새 요약 dict 반환.
+
+    아직 갱신할 만큼 밀려난 메시지가 없거나 요청이 실패하면 기존 요약을 그대로 돌려준다.
+    """
+    summary = summary or {"upto": 0, "text": ""}
+    if cut - summary["upto"] < SUMMARY_REFRESH_EVERY: return summary
+    start = _tail_within(messages, cut, SUMMARY_INPUT_BUDGET, start=summary["upto"])
+    transcript = "\n\n".join(f"{m['role']}: {m['content']}" for k, m in enumerate(messages[start:cut], start)
+                               if not _is_fanout_sibling(messages, k))
+    prompt = (f"Existing summary:\n{summary['text']}\n\n" if summary["text"] else "") + \
+        f"New conversation turns:\n{transcript}\n\n" \
+        "Update the summary of this conversation so far. Keep facts, decisions, names and open questions. " \
+        "Reply with the summary only, in the conversation's language."
+    try:
+        res = get_gemini_client().post(f"models/{SUMMARY_MODEL}:generateContent", api_key, {
+            "contents": [{"role": "user", "parts": [{"text": prompt}]}],
+            "generationConfig": {"temperature": 0.2, "maxOutputTokens": 1024}})
+        cands = res.json().get("candidates", []) if res.status_code == 200 else []
+        text = gemini_candidate_text(cands[0]) if cands else ""
+        if text: return {"upto": cut, "text": text}
+    except: pass
+    return summary
+
 # --- Telegram Async 유틸리티 ---
-def _run_async(coro):
-    result = [None]
-    exception = [None]
-    def runner():
+TG_CALL_TIMEOUT = 30
+
+class TelegramWorker:
+    """프로세스 전체에서 공유하는 Telegram 워커.
+
+    전용 스레드 하나가 이벤트 루프를 계속 돌리고, 세션 파일별로 연결된
+    TelegramClient를 재사용한다. 호출마다 connect/disconnect 하지 않으므로
+    전송·조회는 왕복 1회로 끝난다.
+    """
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.clients = {}  # session name -> (client, api_id, api_hash)
+        self.subscribers = {}  # (session name, bot) -> WeakSet[queue.Queue]
+        self.handlers = {}  # (session name, bot) -> 핸들러가 등록된 client
+        self.flood_until = {}  # session name -> FloodWait가 끝나는 시각 (time.monotonic)
+        self.thread = threading.Thread(target=self.loop.run_forever, name="telegram-worker", daemon=True)
+        self.thread.start()
+
+    async def _client(self, api_id, api_hash, phone):
+        from telethon import TelegramClient
+        name = _get_session_name(phone)
+        client, c_id, c_hash = self.clients.get(name, (None, None, None))
+        if client is not None and (c_id, c_hash) != (api_id, api_hash):
+            await client.disconnect(); client = None
+        if client is None:
+            client = TelegramClient(name, int(api_id), api_hash)
+            self.clients[name] = (client, api_id, api_hash)
+            with get_metrics().span("tg.connect"): await client.connect()
+            # 클라이언트가 새로 만들어졌으면 기존 구독 핸들러를 다시 건다
+            for sub_name, bot in list(self.subscribers):
+                if sub_name == name: await self._attach(client, name, bot)
+        elif not client.is_connected():
+            with get_metrics().span("tg.connect"): await client.connect()
+        return client
+
+    async def _attach(self, client, name, bot_username):
+        key = (name, bot_username)
+        if self.handlers.get(key) is client: return
+        from telethon import events
+        entity = await client.get_input_entity(bot_username)
+        async def _on_update(event):
+            get_tg_media().schedule(client, event.message)
+            msg = _tg_message_dict(event.message)
+            for q in list(self.subscribers.get(key, ())): q.put(msg)
+        client.add_event_handler(_on_update, events.NewMessage(chats=entity))
+        client.add_event_handler(_on_update, events.MessageEdited(chats=entity))
+        self.handlers[key] = client
+
+    def subscribe(self, api_id, api_hash, phone, bots):
+        """bots 각각의 NewMessage/MessageEdited 이벤트를 받는 큐 {bot: queue} 반환.
+
+        구독자(브라우저 세션)마다 별도 큐를 주며, 큐를 버리면 자동으로 구독 해제된다.
+        """
+        name = _get_session_name(phone)
+        queues = {bot: queue.Queue() for bot in bots}
+        for bot, q in queues.items():
+            self.subscribers.setdefault((name, bot), weakref.WeakSet()).add(q)
+        async def _subscribe(client): await asyncio.gather(*(self._attach(client, name, bot) for bot in bots))
+        self.call(api_id, api_hash, phone, _subscribe)
+        return queues
+
+    async def _call(self, api_id, api_hash, phone, fn, retry):
+        with get_metrics().span(f"tg.{fn.__name__.strip('_')}"):
+            client = await self._client(api_id, api_hash, phone)
+            try:
+                return await fn(client)
+            except (ConnectionError, OSError):
+                # 끊어진 연결 — 다음 호출은 재연결된다. 조회처럼 다시 해도 안전한 요청만 한 번 재시도
+                # (전송·로그인은 서버가 이미 받았을 수 있어 오류를 그대로 돌려준다)
+                await client.disconnect()
+                if not retry: raise
+                return await fn(await self._client(api_id, api_hash, phone))
+
+    def submit(self, api_id, api_hash, phone, fn, retry=True):
+        """fn(client) 코루틴을 워커 루프에서 실행하고 concurrent.futures.Future 반환 (thread-safe).
+        fn이 멱등이 아니면(메시지 전송, 코드 요청·로그인) retry=False"""
+        return asyncio.run_coroutine_threadsafe(self._call(api_id, api_hash, phone, fn, retry), self.loop)
+
+    def call(self, api_id, api_hash, phone, fn, timeout=TG_CALL_TIMEOUT, retry=True):
+        future = self.submit(api_id, api_hash, phone, fn, retry)
         try:
-            loop = asyncio.new_event_loop()
-            asyncio.set_event_loop(loop)
-            result[0] = loop.run_until_complete(coro)
-            loop.close()
-        except Exception as e:
-            exception[0] = e
-    t = threading.Thread(target=runner)
-    t.start()
-    t.join(timeout=30)
-    if exception[0]:
-        raise exception[0]
-    return result[0]
+            return future.result(timeout=timeout)
+        except:
+            future.cancel(); raise
+
+    def gather(self, api_id, api_hash, phone, fns, limit=TG_FETCH_CONCURRENCY, timeout=TG_CALL_TIMEOUT):
+        """fn(client) 여러 개를 연결 하나에서 최대 limit개씩 동시에 실행. 결과 리스트 (실패한 항목은 예외 객체).
+
+        FloodWait를 받으면 같은 계정의 나머지 요청도 대기가 끝날 때까지 보내지 않는다.
+        TG_FLOOD_WAIT_MAX 이하면 기다렸다 한 번 재시도하고, 더 길면 그 항목만 실패로 돌린다.
+        """
+        name = _get_session_name(phone)
+        async def _gather(client):
+            from telethon.errors import FloodWaitError
+            sem = asyncio.Semaphore(limit)
+            async def _one(fn):
+                async with sem:
+                    for attempt in range(2):
+                        wait = self.flood_until.get(name, 0) - time.monotonic()
+                        if wait > TG_FLOOD_WAIT_MAX: raise RuntimeError(f"FloodWait: retry in {wait:.0f}s")
+                        if wait > 0: await asyncio.sleep(wait)
+                        try:
+                            return await asyncio.wait_for(fn(client), timeout)
+                        except FloodWaitError as e:
+                            self.flood_until[name] = max(self.flood_until.get(name, 0), time.monotonic() + e.seconds)
+                            if attempt: raise
+            results = await asyncio.gather(*(_one(fn) for fn in fns), return_exceptions=True)
+            # 연결이 끊겼으면 _call이 재연결 후 전체를 한 번 더 시도 (조회는 여러 번 해도 안전)
+            lost = next((r for r in results if isinstance(r, ConnectionError)), None)
+            if lost: raise lost
+            return results
+        return self.call(api_id, api_hash, phone, _gather, timeout=timeout * math.ceil(len(fns) / limit) + TG_FLOOD_WAIT_MAX)
+
+@st.cache_resource
+def get_tg_worker():
+    return TelegramWorker()
 
 def _get_session_name(phone):
     return f"session_{phone.replace('+','').replace(' ','')}"
 
 def tg_authenticate(api_id, api_hash, phone):
     try:
-        from telethon import TelegramClient
-        async def _auth():
-            client = TelegramClient(_get_session_name(phone), int(api_id), api_hash)
-            await client.connect()
+        async def _auth(client):
             if not await client.is_user_authorized():
                 sent = await client.send_code_request(phone)
-                await client.disconnect()
                 return ("CODE_NEEDED", sent.phone_code_hash)
-            await client.disconnect()
             return ("AUTHORIZED", None)
-        return _run_async(_auth())
+        return get_tg_worker().call(api_id, api_hash, phone, _auth, retry=False)
     except Exception as e:
         return (f"ERROR: {str(e)}", None)
 
 def tg_verify_code(api_id, api_hash, phone, code, phone_code_hash):
     try:
-        from telethon import TelegramClient
-        async def _verify():
-            client = TelegramClient(_get_session_name(phone), int(api_id), api_hash)
-            await client.connect()
+        async def _verify(client):
             await client.sign_in(phone, code, phone_code_hash=phone_code_hash)
             authorized = await client.is_user_authorized()
-            await client.disconnect()
             return "AUTHORIZED" if authorized else "FAILED"
-        return _run_async(_verify())
+        return get_tg_worker().call(api_id, api_hash, phone, _verify, retry=False)
     except Exception as e:
         return f"ERROR: {str(e)}"
 
 def tg_send_via_user_api(api_id, api_hash, phone, bot_username, message):
     try:
-        from telethon import TelegramClient
-        async def _send():
-            client = TelegramClient(_get_session_name(phone), int(api_id), api_hash)
-            await client.connect()
-            await client.send_message(bot_username, message)
-            await client.disconnect()
-            return True
-        return _run_async(_send())
+        async def _send(client):
+            return _tg_message_dict(await client.send_message(bot_username, message))
+        return get_tg_worker().call(api_id, api_hash, phone, _send, retry=False)
     except Exception as e:
         return str(e)
 
-def tg_get_bot_replies(api_id, api_hash, phone, bot_username, limit=50):
+def _tg_message_dict(msg):
+    d = {
+        "id": msg.id, "text": msg.text or "",
+        "from_me": msg.out,
+        "date": msg.date.strftime("%H:%M") if msg.date else "",
+        "date_full": msg.date.strftime("%Y-%m-%d %H:%M:%S") if msg.date else ""
+    }
+    media = _tg_media_info(msg)
+    if media: d["media"] = media
+    return d
+
+def _tg_media_info(msg):
+    """사진·문서·음성 첨부 메타데이터. file_id는 Telegram 파일 id라 같은 파일은 한 번만 받는다."""
+    photo, doc = getattr(msg, "photo", None), getattr(msg, "document", None)
+    if photo is None and doc is None: return None
+    f = msg.file
+    if photo is not None:
+        return {"file_id": f"p{photo.id}", "kind": "photo", "name": "photo.jpg", "mime": "image/jpeg", "size": f.size or 0}
+    kind = ("voice" if msg.voice else "video" if msg.video else "audio" if msg.audio
+            else "sticker" if msg.sticker else "document")
+    return {"file_id": f"d{doc.id}", "kind": kind, "name": f.name or f"{kind}{f.ext or ''}",
+            "mime": doc.mime_type or "", "size": doc.size or 0}
+
+def _tg_history_fn(bot_username, limit=50, min_id=0, offset_id=0):
+    """min_id: 이 id보다 새 메시지만 (오래된 것부터), offset_id: 이 id보다 오래된 메시지만"""
+    kwargs = {"limit": limit}
+    if min_id: kwargs.update(min_id=min_id, reverse=True)
+    if offset_id: kwargs["offset_id"] = offset_id
+    media = get_tg_media()
+    async def _get(client):
+        messages = []
+        async for msg in client.iter_messages(bot_username, **kwargs):
+            media.schedule(client, msg)
+            messages.append(_tg_message_dict(msg))
+        messages.sort(key=lambda m: m["id"])
+        return messages
+    return _get
+
+def tg_get_bot_replies(api_id, api_hash, phone, bot_username, limit=50, min_id=0, offset_id=0):
     try:
-        from telethon import TelegramClient
-        async def _get():
-            client = TelegramClient(_get_session_name(phone), int(api_id), api_hash)
-            await client.connect()
-            messages = []
-            async for msg in client.iter_messages(bot_username, limit=limit):
-                messages.append({
-                    "id": msg.id, "text": msg.text or "",
-                    "from_me": msg.out,
-                    "date": msg.date.strftime("%H:%M") if msg.date else "",
-                    "date_full": msg.date.strftime("%Y-%m-%d %H:%M:%S") if msg.date else ""
-                })
-            await client.disconnect()
-            messages.reverse()
-            return messages
-        return _run_async(_get())
+        return get_tg_worker().call(api_id, api_hash, phone, _tg_history_fn(bot_username, limit, min_id, offset_id))
     except Exception as e:
         return str(e)
 
-def tg_fetch_messages():
-    """공통: Telegram 메시지 갱신"""
-    result = tg_get_bot_replies(
+def merge_tg_messages(messages, incoming):
+    """id 기준 병합 (in-place, id 오름차순 유지). 전부 새 id면 뒤에 붙이기만 한다."""
+    if not incoming: return messages
+    incoming = sorted(incoming, key=lambda m: m["id"])
+    if not messages or incoming[0]["id"] > messages[-1]["id"]:
+        messages.extend(incoming)
+        return messages
+    by_id = {m["id"]: m for m in messages}
+    by_id.update((m["id"], m) for m in incoming)
+    messages[:] = sorted(by_id.values(), key=lambda m: m["id"])
+    return messages
+
+def tg_dialogs():
+    """사이드바 Bot 칸의 대화 목록 (쉼표·공백 구분, 순서 유지, 중복 제거)"""
+    names = [n.strip().lower() for n in re.split(r"[,\s]+", st.session_state.tg_bot_username)]
+    return list(dict.fromkeys(n for n in names if n))
+
+def _tg_fetch(dialog, **kwargs):
+    return tg_get_bot_replies(
         st.session_state.tg_api_id, st.session_state.tg_api_hash,
-        st.session_state.tg_phone, st.session_state.tg_bot_username, limit=100
+        st.session_state.tg_phone, dialog, **kwargs
     )
+
+def tg_fetch_messages(dialogs):
+    """공통: 대화별 증분 동기화 — 각자 마지막 동기화 지점(watermark) 이후만, 연결 하나로 동시에 요청.
+    실패한 대화의 {dialog: 오류} 반환 (전부 성공하면 빈 dict)"""
+    fns = []
+    for dialog in dialogs:
+        watermark = get_tg_log(dialog).synced
+        fns.append(_tg_history_fn(dialog, min_id=watermark, limit=None) if watermark else _tg_history_fn(dialog, limit=TG_PAGE_SIZE))
+    try:
+        results = get_tg_worker().gather(st.session_state.tg_api_id, st.session_state.tg_api_hash,
+                                         st.session_state.tg_phone, fns)
+    except Exception as e:
+        return {dialog: str(e) for dialog in dialogs}
+    errors = {}
+    for dialog, result in zip(dialogs, results):
+        if isinstance(result, BaseException): errors[dialog] = str(result) or type(result).__name__
+        elif result:
+            append_tg_history(dialog, "upsert", msgs=result)
+            get_tg_log(dialog).mark_synced(result[-1]["id"])
+    return errors
+
+def tg_ensure_subscription(dialogs):
+    """라이브 구독 (브라우저 세션·대화당 1회). 새로 구독한 대화의 비어 있던 구간은 한 번의 동시 동기화로 메운다."""
+    queues = st.session_state.setdefault("tg_live_queues", {})  # (phone, dialog) -> queue
+    phone = st.session_state.tg_phone
+    new = [d for d in dialogs if (phone, d) not in queues]
+    if not new: return True
+    try:
+        subscribed = get_tg_worker().subscribe(st.session_state.tg_api_id, st.session_state.tg_api_hash, phone, new)
+    except Exception as e:
+        return str(e)
+    queues.update(((phone, d), q) for d, q in subscribed.items())
+    tg_fetch_messages(new)
+    return True
+
+def tg_drain_updates():
+    """구독 큐에 쌓인 메시지를 대화별로 병합. 새 메시지가 있었는지 반환"""
+    changed = False
+    for (phone, dialog), q in st.session_state.get("tg_live_queues", {}).items():
+        if phone != st.session_state.tg_phone: continue
+        msgs = []
+        while True:
+            try: msgs.append(q.get_nowait())
+            except queue.Empty: break
+        if msgs: append_tg_history(dialog, "upsert", msgs=msgs); changed = True
+    return changed
+
+@st.fragment(run_every=1)
+def tg_live_listener():
+    # 이 fragment만 1초마다 돌며, 새 메시지나 첨부 다운로드 완료가 있을 때만 전체 rerun
+    if tg_drain_updates() or st.session_state.get("tg_media_version", 0) != get_tg_media().version: st.rerun()
+
+def tg_fetch_older_messages(dialog):
+    """가장 오래된 저장 메시지 이전 기록을 한 페이지 불러와 병합. 가져온 개수 반환 (실패 시 None)"""
+    messages = get_tg_log(dialog).messages
+    result = _tg_fetch(dialog, offset_id=messages[0]["id"] if messages else 0, limit=TG_PAGE_SIZE)
     if isinstance(result, list):
-        st.session_state.tg_messages = result
-        save_tg_history()
-        return True
-    return False
+        if result: append_tg_history(dialog, "upsert", msgs=result)
+        return len(result)
+    return None
+
+# --- Telegram 첨부 파일 ---
+def _make_thumbnail(data):
+    try:
+        from PIL import Image
+        import io
+        img = Image.open(io.BytesIO(data))
+        img.thumbnail((TG_THUMB_SIZE, TG_THUMB_SIZE))
+        out = io.BytesIO()
+        img.convert("RGB").save(out, "JPEG", quality=80)
+        return out.getvalue()
+    except Exception:
+        return None
+
+class TelegramMediaCache:
+    """첨부 파일을 file_id 기준으로 한 번만 받아 두는 디스크 캐시 (프로세스 공유).
+
+    다운로드는 Telegram 워커 루프에서 세마포어로 동시 수를 제한해 돌고,
+    암호화·파일 쓰기는 실행기 스레드에서 한다. 썸네일은 받을 때 한 번 만든다.
+    전체 크기가 상한을 넘으면 오래 안 쓴 파일부터 지운다.
+    """
+    def __init__(self, root=TG_MEDIA_DIR, max_bytes=TG_MEDIA_CACHE_BYTES):
+        self.root = root
+        self.max_bytes = max_bytes
+        os.makedirs(root, exist_ok=True)
+        self.index_path = os.path.join(root, "index.dat")
+        self.index = _load_encrypted_json(self.index_path, {})  # file_id -> {"size", "thumb", "atime"}
+        self.inflight = set()
+        self.requested = set()  # 다시 조회를 요청한 file_id (반복 요청 방지, 실패하면 빼서 재시도)
+        self.sem = asyncio.Semaphore(TG_MEDIA_CONCURRENCY)
+        self.lock = threading.Lock()
+        self.version = 0  # 다운로드가 끝날 때마다 증가 — 화면 갱신 판단용
+
+    def _path(self, file_id, ext):
+        return os.path.join(self.root, f"{file_id}.{ext}")
+
+    def has(self, file_id):
+        return file_id in self.index
+
+    def schedule(self, client, msg):
+        """워커 루프 안에서 호출: 아직 없는 첨부만 백그라운드 다운로드 작업으로 건다"""
+        info = _tg_media_info(msg)
+        if info is None: return
+        with self.lock:
+            if info["file_id"] in self.index or info["file_id"] in self.inflight: return
+            self.inflight.add(info["file_id"])
+        asyncio.get_running_loop().create_task(self._download(client, msg, info))
+
+    def prefetch(self, api_id, api_hash, phone, bot_username, msgs):
+        """저장된 기록에만 있고 캐시에 없는 첨부 — 메시지를 다시 조회해 다운로드를 건다"""
+        with self.lock:
+            wanted = {m["media"]["file_id"]: m["id"] for m in msgs if m.get("media") and m["media"]["file_id"] not in self.requested
+                      and m["media"]["file_id"] not in self.index and m["media"]["file_id"] not in self.inflight}
+            self.requested.update(wanted)
+        if not wanted: return
+        async def _prefetch(client):
+            try:
+                found = await client.get_messages(bot_username, ids=list(wanted.values()))
+            except Exception:
+                with self.lock: self.requested.difference_update(wanted)
+                raise
+            for msg in found:
+                if msg is not None: self.schedule(client, msg)
+        get_tg_worker().submit(api_id, api_hash, phone, _prefetch)
+
+    async def _download(self, client, msg, info):
+        try:
+            async with self.sem:
+                with get_metrics().span("tg.media_download", kind=info["kind"]):
+                    data = await client.download_media(msg, file=bytes) if info["size"] <= TG_MEDIA_MAX_FILE else None
+                    if data and info["mime"].startswith("image/"): thumb_src = data
+                    elif getattr(msg.document, "thumbs", None): thumb_src = await client.download_media(msg, file=bytes, thumb=-1)
+                    else: thumb_src = None
+            await asyncio.get_running_loop().run_in_executor(None, self._store, info, data, thumb_src)
+        except Exception:
+            with self.lock: self.requested.discard(info["file_id"])  # 다음 렌더링 때 prefetch가 다시 시도
+        finally:
+            with self.lock: self.inflight.discard(info["file_id"])
+
+    def _store(self, info, data, thumb_src):
+        thumb = _make_thumbnail(thumb_src) if thumb_src else None
+        if data: _atomic_write(self._path(info["file_id"], "bin"), encrypt_bytes(data, ACCESS_PASSWORD))
+        if thumb: _atomic_write(self._path(info["file_id"], "thumb"), encrypt_bytes(thumb, ACCESS_PASSWORD))
+        with self.lock:
+            self.index[info["file_id"]] = {"size": len(data or b"") + len(thumb or b""), "file": bool(data),
+                                           "thumb": bool(thumb), "atime": time.time()}
+            self._evict()
+            self.version += 1
+        schedule_encrypted_json(self.index_path, self._snapshot)
+
+    def _snapshot(self):
+        with self.lock: return dict(self.index)
+
+    def _evict(self):
+        total = sum(e["size"] for e in self.index.values())
+        for file_id, entry in sorted(self.index.items(), key=lambda kv: kv[1]["atime"]):
+            if total <= self.max_bytes: break
+            for ext in ("bin", "thumb"):
+                if os.path.exists(self._path(file_id, ext)): os.remove(self._path(file_id, ext))
+            total -= entry["size"]; del self.index[file_id]
+
+    def has_file(self, file_id):
+        entry = self.index.get(file_id)
+        return bool(entry and entry.get("file"))
+
+    def read(self, file_id):
+        """저장된 첨부 원본을 복호화해 반환 (없으면 None)"""
+        if not self.has_file(file_id): return None
+        try:
+            with open(self._path(file_id, "bin"), "rb") as f:
+                data = decrypt_bytes(f.read(), ACCESS_PASSWORD)
+        except OSError:
+            return None
+        self.index[file_id]["atime"] = time.time()
+        return data
+
+    def thumb(self, file_id):
+        entry = self.index.get(file_id)
+        if not entry or not entry.get("thumb"): return None
+        try:
+            with open(self._path(file_id, "thumb"), "rb") as f:
+                data = decrypt_bytes(f.read(), ACCESS_PASSWORD)
+        except OSError:
+            return None
+        entry["atime"] = time.time()
+        return data
+
+@st.cache_resource
+def get_tg_media():
+    return TelegramMediaCache()
+
+TG_MEDIA_ICONS = {"photo": "🖼️", "voice": "🎤", "audio": "🎵", "video": "🎬", "sticker": "🏷️"}
+
+def tg_media_html(media):
+    # 받은 썸네일은 말풍선 HTML에 넣지 않는다 (render_tg_transcript가 st.image로 따로 보냄)
+    icon = TG_MEDIA_ICONS.get(media["kind"], "📎")
+    name = media["name"].replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+    state = "" if get_tg_media().has(media["file_id"]) else " · ⏳"
+    return f'<div class="tg-file">{icon} {name} · {media["size"] / 1024:.0f} KB{state}</div>'
+
+def tg_attachment_downloads(dialog, messages):
+    """받아 둔 첨부 원본 다운로드 버튼 (최신순). 복호화는 버튼을 누를 때만 한다."""
+    media = get_tg_media()
+    files = [m for m in reversed(messages) if m.get("media") and media.has_file(m["media"]["file_id"])]
+    if not files: return
+    with st.expander(f"📎 Attachments ({len(files)})", expanded=False):
+        for m in files:
+            info = m["media"]
+            st.download_button(f"{TG_MEDIA_ICONS.get(info['kind'], '📎')} {info['name']} · {info['size'] / 1024:.0f} KB · {m.get('date_full', '')}",
+                               data=lambda fid=info["file_id"]: media.read(fid) or b"", file_name=info["name"],
+                               mime=info["mime"] or "application/octet-stream", on_click="ignore",
+                               key=f"tg_dl_{dialog}_{m['id']}", use_container_width=True)
+
+# --- 렌더링 캐시 ---
+class FragmentCache:
+    """렌더링된 HTML 조각의 LRU 캐시 (프로세스 공유).
+
+    키에 메시지 id와 내용 해시를 넣으므로 내용이 바뀌면 자연히 새로 만든다.
+    str의 hash()는 객체에 캐시되어 같은 메시지 문자열에 대해서는 O(1)이다.
+    """
+    def __init__(self, max_entries=RENDER_CACHE_SIZE):
+        self.data = collections.OrderedDict()
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+
+    def get(self, key, build):
+        with self.lock:
+            html = self.data.get(key)
+            if html is not None:
+                self.data.move_to_end(key)
+                return html
+        html = build()
+        with self.lock:
+            self.data[key] = html
+            if len(self.data) > self.max_entries: self.data.popitem(last=False)
+        return html
+
+@st.cache_resource
+def get_fragment_cache():
+    return FragmentCache()
+
+def copy_buttons_html(bid, content):
+    b64 = base64.b64encode(content.encode('utf-8')).decode('utf-8')
+    bm, bt = f"c_m_{bid}", f"c_t_{bid}"
+    return f'<div class="copy-btn-wrapper"><button id="{bm}" class="custom-copy-btn" onclick="copyBase64(\'{b64}\',\'{bm}\',\'md\')">📋 MD</button><button id="{bt}" class="custom-copy-btn" onclick="copyBase64(\'{b64}\',\'{bt}\',\'txt\')">📝 TXT</button></div>'
+
+def sources_html(sources):
+    return "<div class='source-box'>📚 <b>Sources:</b><br>" + "".join([f"• <a href='{s['uri']}' target='_blank'>{s.get('title','Link')}</a><br>" for s in sources]) + "</div>"
+
+def tg_bubble_html(msg, thumb=False):
+    """thumb: 썸네일을 말풍선 위에 따로 그리는 메시지 (사진만 있으면 시각만 남긴다)"""
+    text = (msg.get('text','')
+            .replace('&','&amp;').replace('<','&lt;').replace('>','&gt;')
+            .replace('\n','<br>'))
+    if msg.get("media") and not thumb: text = tg_media_html(msg["media"]) + text
+    t = msg.get('date','')
+    cls = "me" if msg.get("from_me") else "bot"
+    bubble = f'<div class="tg-bubble {cls}">{text}</div>' if text else ""
+    return f'<div class="tg-row {cls}"><div>{bubble}<div class="tg-ts {cls}">{t}</div></div></div>'
+
+def tg_transcript_segments(messages, window):
+    """최근 window개 말풍선을 [(html, 썸네일 bytes 또는 None, from_me)] 구간으로 나눈다.
+    메시지별 HTML은 캐시되어 새로 동기화된(또는 수정된) 것만 이스케이프한다. 썸네일은 HTML(과 캐시)에
+    넣지 않고 그 메시지 앞에서 구간을 끊는다."""
+    frags = get_fragment_cache()
+    media = get_tg_media()
+    segments, parts, thumb, from_me = [], [], None, False
+    for m in messages[-window:]:
+        info = m.get("media")
+        image = media.thumb(info["file_id"]) if info else None
+        if image:
+            segments.append((parts, thumb, from_me))
+            parts, thumb, from_me = [], image, m.get("from_me")
+        # 첨부는 다운로드 완료 여부도 키에 넣어, 끝나면 그 말풍선만 다시 만든다
+        parts.append(frags.get(("tg", m["id"], hash(m.get("text", "")), m.get("date", ""), bool(info) and media.has(info["file_id"]), bool(image)),
+                               lambda m=m, t=bool(image): tg_bubble_html(m, t)))
+    segments.append((parts, thumb, from_me))
+    return [('<div class="tg-chat-area">' + "".join(p) + '</div>', t, me) for p, t, me in segments if p]
+
+def render_tg_transcript(messages, window):
+    # 썸네일은 st.image로 — 미디어 저장소 URL로 전달되어 rerun마다 말풍선 HTML에 실어 다시 보내지 않는다
+    for html, thumb, from_me in tg_transcript_segments(messages, window):
+        if thumb:
+            left, right = st.columns(2)
+            (right if from_me else left).image(thumb, width=240)
+        st.markdown(html, unsafe_allow_html=True)
+
+# --- 실행 단계 타이밍 ---
+RUN_PHASES = []  # 이번 실행의 (단계, ms) — 스크립트가 다시 돌 때마다 새로 시작
+_phase_mark = time.perf_counter()
+
+def mark_phase(name):
+    """직전 경계부터 지금까지를 name 단계로 기록 (metrics: startup.<name>)"""
+    global _phase_mark
+    now = time.perf_counter()
+    RUN_PHASES.append((name, (now - _phase_mark) * 1000))
+    get_metrics().record(f"startup.{name}", now - _phase_mark)
+    _phase_mark = now
+
+def phases_text(phases):
+    return " · ".join(f"{name} {ms:.0f}ms" for name, ms in phases) + f" = {sum(ms for _, ms in phases):.0f}ms"
 
 # --- 3. 전역 CSS + JS ---
-st.markdown("""
-<style>
+ASSETS_CSS = """
     /* 전체 */
     .stApp { background-color: #f0f2f5; }
     [data-testid="stSidebar"] { background-color: #ffffff; border-right: 1px solid #e5e7eb; }
@@ -232,6 +1094,7 @@ st.markdown("""
         border: 1px solid #e5e7eb; border-bottom-left-radius: 4px;
         box-shadow: 0 1px 2px rgba(0,0,0,0.04);
     }
+    .tg-file { font-size: 12px; opacity: 0.85; margin-bottom: 2px; }
     .tg-ts { font-size: 10px; color: #b0b0b0; margin-top: 1px; padding: 0 6px; }
     .tg-ts.me { text-align: right; }
     .tg-ts.bot { text-align: left; }
@@ -241,9 +1104,9 @@ st.markdown("""
     .empty-state .icon { font-size:48px; margin-bottom:12px; }
     .empty-state .title { font-size:17px; font-weight:600; color:#6b7280; }
     .empty-state .sub { font-size:13px; margin-top:6px; }
-</style>
+"""
 
-<script>
+ASSETS_JS = """
     // 복사 기능
     if (typeof window.copyBase64 === 'undefined') {
         window.copyBase64 = async function(b64text, btnId, mode) {
@@ -283,8 +1146,27 @@ st.markdown("""
             if(t) obs.observe(t, {childList:true, subtree:true});
         }, 500);
     })();
-</script>
-""", unsafe_allow_html=True)
+"""
+
+def inject_assets():
+    """CSS·JS를 부모 문서 <head>에 브라우저 세션당 한 번만 넣는다.
+
+    st.markdown으로 넣으면 매 실행마다 다시 보내야 하지만(빠지면 스타일도 사라짐),
+    head에 붙인 요소는 iframe이 사라져도 남는다. 로그인 화면이 첫 실행이라 곧바로 rerun 되지 않는다.
+    """
+    if st.session_state.get("assets_injected"): return
+    st.session_state.assets_injected = True
+    st.iframe(f"""<script>
+        const d = window.parent.document;
+        if (!d.getElementById("pc-assets")) {{
+            const style = d.createElement("style"); style.id = "pc-assets"; style.textContent = {json.dumps(ASSETS_CSS)};
+            d.head.appendChild(style);
+            const script = d.createElement("script"); script.textContent = {json.dumps(ASSETS_JS)};
+            d.head.appendChild(script);
+        }}
+    </script>""", height=1)
+
+inject_assets()
 
 
 # --- 4. 인증 ---
@@ -303,38 +1185,824 @@ def check_password():
                 else: st.error("Access Denied")
         st.stop() 
 
-def load_history():
-    if os.path.exists(HISTORY_FILE):
+def _load_encrypted_json(path, default):
+    """암호화된 JSON 파일 로드. v1 포맷이면 읽은 뒤 v2로 한 번 다시 저장한다."""
+    if os.path.exists(path):
         try:
-            with open(HISTORY_FILE, "r", encoding="utf-8") as f:
-                return json.loads(decrypt_data(f.read(), ACCESS_PASSWORD))
+            with open(path, "r", encoding="utf-8") as f:
+                raw = f.read()
+            data = json.loads(decrypt_data(raw, ACCESS_PASSWORD))
+            if is_legacy_cipher(raw):
+                _save_encrypted_json(path, data)
+            return data
         except: pass
-    return [{"id": str(uuid.uuid4()), "title": "Session 1", "messages": []}]
+    return default
+
+def _save_encrypted_json(path, data):
+    with get_metrics().span("store.save_json"):
+        _atomic_write(path, encrypt_data(json.dumps(data, ensure_ascii=False), ACCESS_PASSWORD))
+
+def _atomic_write(path, data):
+    """임시 파일에 쓰고 fsync 후 rename — 중간에 죽어도 기존 파일은 온전하다.
+    임시 파일 이름은 쓰기마다 달라서 같은 path를 여러 스레드가 동시에 써도 서로의 임시 파일을 건드리지 않는다."""
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path) or ".", prefix=f"{os.path.basename(path)}.", suffix=".tmp")
+    binary = isinstance(data, bytes)
+    try:
+        with os.fdopen(fd, "wb" if binary else "w", encoding=None if binary else "utf-8") as f:
+            f.write(data); f.flush(); os.fsync(f.fileno())
+        os.replace(tmp, path)
+    except BaseException:
+        with contextlib.suppress(OSError): os.remove(tmp)
+        raise
+
+def _fsync_file(path):
+    if os.path.exists(path):
+        with open(path, "a", encoding="utf-8") as f: os.fsync(f.fileno())
+
+class PersistenceService:
+    """디바운스된 백그라운드 저장.
+
+    schedule(key, job)으로 들어온 작업은 PERSIST_DEBOUNCE 동안 모았다가 전용
+    스레드에서 실행하고, 같은 key는 마지막 작업 한 번만 실행한다. 스크립트
+    스레드는 파일 I/O를 기다리지 않는다. 종료 시(atexit)와 Lock 시 flush 한다.
+    """
+    def __init__(self, delay=PERSIST_DEBOUNCE):
+        self.delay = delay
+        self.pending = {}
+        self.cond = threading.Condition()
+        self.write_lock = threading.Lock()
+        self.thread = threading.Thread(target=self._run, name="persistence", daemon=True)
+        self.thread.start()
+        atexit.register(self.flush)
+
+    def schedule(self, key, job):
+        with self.cond:
+            self.pending[key] = job
+            self.cond.notify()
+
+    def cancel(self, key):
+        """아직 실행되지 않은 key 작업을 버린다 (이미 실행 중인 작업은 그대로 끝난다)"""
+        with self.cond: self.pending.pop(key, None)
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while not self.pending: self.cond.wait()
+            time.sleep(self.delay)  # 그동안 들어온 변경은 합쳐짐
+            self.flush()
+
+    def flush(self):
+        with self.cond:
+            batch, self.pending = self.pending, {}
+        with self.write_lock:
+            for key, job in batch.items():
+                try: job()
+                except Exception:
+                    # 직렬화 중 상태가 바뀌는 등 일시적 실패 — 새 요청이 없으면 다시 예약
+                    with self.cond: self.pending.setdefault(key, job)
+
+@st.cache_resource
+def get_persistence():
+    return PersistenceService()
+
+def schedule_encrypted_json(path, produce):
+    """produce()의 결과를 암호화해 원자적으로 쓰는 작업을 예약 (path 단위로 합쳐짐)"""
+    get_persistence().schedule(path, lambda: _atomic_write(path, encrypt_data(json.dumps(produce(), ensure_ascii=False), ACCESS_PASSWORD)))
+
+class EncryptedJournal:
+    """스냅샷 파일 + append-only 암호화 저널.
+
+    변경 1건 = 저널 1줄(암호문)이라 저장 비용이 전체 크기와 무관하다.
+    레코드마다 seq를 붙이고 스냅샷에 마지막 seq를 함께 기록하므로,
+    압축 도중 크래시가 나도 재생 시 같은 레코드가 두 번 적용되지 않는다.
+    """
+    def __init__(self, snapshot_path, journal_path, apply_fn, empty_fn, decode_fn=None, encode_default=None):
+        self.snapshot_path = snapshot_path
+        self.journal_path = journal_path
+        self.rotated_path = f"{journal_path}.old"
+        self.apply_fn = apply_fn
+        self.empty_fn = empty_fn
+        self.decode_fn = decode_fn  # 스냅샷 JSON -> 상태 객체
+        self.encode_default = encode_default  # json.dumps(default=...) — 스냅샷 저장 시 백그라운드에서 변환
+        self.seq = 0
+        self.pending = 0
+        self.lock = threading.Lock()
+        self.write_lock = threading.Lock()  # 스냅샷 쓰기 직렬화
+        self.written_seq = 0  # 디스크에 있는 스냅샷의 seq
+        self.compacting = False
+        self.resumed = False  # load 없이 resume()으로 seq를 이어받았는지
+        self.closed = False  # 파일을 지운 뒤에는 예약돼 있던 스냅샷도 쓰지 않음
+
+    def _read_records(self, path):
+        """저널 재생. 마지막 줄이 깨졌으면(쓰기 도중 크래시) 그 줄만 잘라낸다.
+        중간의 깨진 줄은 건너뛰고 나머지를 계속 재생하며, 원본은 .corrupt로 복사해 둔다."""
+        if not os.path.exists(path): return []
+        with open(path, "r", encoding="utf-8") as f:
+            text = f.read()
+        lines = [l for l in text.split("\n") if l]
+        records, bad = [], []
+        for n, line in enumerate(lines):
+            try: records.append(json.loads(decrypt_data(line, ACCESS_PASSWORD)))
+            except: bad.append(n)
+        if any(n != len(lines) - 1 for n in bad):
+            _atomic_write(f"{path}.corrupt", text)
+        if bad and bad[-1] == len(lines) - 1:
+            _atomic_write(path, "".join(l + "\n" for l in lines[:-1]))
+        return records
+
+    def load(self):
+        with get_metrics().span("store.load"):
+            return self._load()
+
+    def _load(self):
+        snap = _load_encrypted_json(self.snapshot_path, None)
+        if isinstance(snap, dict) and "state" in snap:
+            state, self.seq = snap["state"], snap.get("seq", 0)
+            if self.decode_fn: state = self.decode_fn(state)
+        elif snap is not None:
+            state, self.seq = snap, 0  # 저널 도입 이전 포맷
+        else:
+            state, self.seq = self.empty_fn(), 0
+        self.written_seq = self.seq
+        self.pending = 0
+        for path in (self.rotated_path, self.journal_path):
+            for rec in self._read_records(path):
+                if rec.get("seq", 0) <= self.seq: continue
+                if rec.get("op") != "seq":  # 회전 표식은 seq만 이어받는다
+                    state = self.apply_fn(state, rec); self.pending += 1
+                self.seq = rec["seq"]
+        return state
+
+    def resume(self):
+        """스냅샷을 읽지 않고 저널만으로 seq를 이어받는다 (load 없이 append만 할 때). 알 수 없으면 False.
+        회전할 때 새 저널 첫 줄에 seq 표식을 남기므로, 스냅샷이 있는데 저널이 비어 있는 경우는 이전 버전뿐이다."""
+        seq, pending = None, 0
+        for path in (self.rotated_path, self.journal_path):
+            for rec in self._read_records(path):
+                seq = max(seq or 0, rec.get("seq", 0))
+                if path == self.journal_path and rec.get("op") != "seq": pending += 1
+        if seq is None:
+            if os.path.exists(self.snapshot_path): return False
+            seq = 0
+        self.seq, self.pending = seq, pending
+        return True
+
+    def append(self, record):
+        with self.lock, get_metrics().span("store.append"):
+            self.seq += 1
+            self._write_record(dict(record, seq=self.seq))
+            self.pending += 1
+        # write()만으로 프로세스 크래시에는 안전, 디스크 fsync는 모아서 백그라운드로
+        get_persistence().schedule(("fsync", self.journal_path), lambda: _fsync_file(self.journal_path))
+
+    def _write_record(self, rec):
+        line = encrypt_data(json.dumps(rec, ensure_ascii=False), ACCESS_PASSWORD)
+        with open(self.journal_path, "a", encoding="utf-8") as f:
+            f.write(line + "\n")
+
+    def maybe_compact(self, snapshot_fn, force=False):
+        """pending이 임계값을 넘으면 저널을 회전시키고 스냅샷 작성을 백그라운드 저장에 예약"""
+        with self.lock:
+            if self.compacting or not self.pending or (not force and self.pending < JOURNAL_COMPACT_EVERY): return
+            self.compacting = True
+            self._rotate()
+            state, seq = snapshot_fn(), self.seq
+            self.pending = 0
+        get_persistence().schedule(("snapshot", self.snapshot_path), lambda: self._write_snapshot(state, seq))
+
+    def compact_now(self, snapshot_fn):
+        """회전과 스냅샷 쓰기를 호출한 스레드에서 바로 한다. 실패하면 예외가 그대로 올라간다.
+        대량 변경을 저널 없이 적용한 뒤 확정할 때 사용."""
+        with self.lock, self.write_lock:
+            self._rotate()
+            state, seq = snapshot_fn(), self.seq
+            self.pending = 0
+            self._store_snapshot(state, seq)
 
-def save_history():
-    data = encrypt_data(json.dumps(st.session_state.sessions, ensure_ascii=False), ACCESS_PASSWORD)
-    with open(HISTORY_FILE, "w", encoding="utf-8") as f: f.write(data)
+    def _rotate(self):
+        # self.lock 안에서 호출
+        if not os.path.exists(self.journal_path): pass
+        elif os.path.exists(self.rotated_path):
+            # 이전 압축이 실패해 남은 회전 저널 — 이어 붙여서 보존
+            with open(self.journal_path, "r", encoding="utf-8") as src, open(self.rotated_path, "a", encoding="utf-8") as dst:
+                dst.write(src.read())
+            os.remove(self.journal_path)
+        else:
+            os.replace(self.journal_path, self.rotated_path)
+        self._write_record({"op": "seq", "seq": self.seq})  # resume()용 표식 — 스냅샷 없이도 seq를 이어받게
 
-def load_tg_history():
-    if os.path.exists(TELEGRAM_HISTORY_FILE):
+    def _store_snapshot(self, state, seq):
+        # write_lock 안에서 호출. 더 최신 스냅샷이 이미 써졌으면 덮어쓰지 않는다 (회전 저널도 그쪽이 정리)
+        if self.closed or seq < self.written_seq: return
+        with get_metrics().span("store.snapshot"):
+            data = json.dumps({"seq": seq, "state": state}, ensure_ascii=False, default=self.encode_default)
+            _atomic_write(self.snapshot_path, encrypt_data(data, ACCESS_PASSWORD))
+        self.written_seq = seq
+        if os.path.exists(self.rotated_path): os.remove(self.rotated_path)
+
+    def close(self):
+        """파일을 지우기 전에 호출: 예약된 스냅샷을 취소하고, 쓰는 중인 스냅샷은 끝나길 기다린 뒤 이후 쓰기를 막는다"""
+        get_persistence().cancel(("snapshot", self.snapshot_path))
+        with self.write_lock: self.closed = True
+
+    def _write_snapshot(self, state, seq):
         try:
-            with open(TELEGRAM_HISTORY_FILE, "r", encoding="utf-8") as f:
-                return json.loads(decrypt_data(f.read(), ACCESS_PASSWORD))
+            with self.write_lock: self._store_snapshot(state, seq)
         except: pass
-    return []
+        finally:
+            self.compacting = False
+
+def _new_history():
+    return [{"id": str(uuid.uuid4()), "title": "Session 1", "messages": []}]
+
+def _apply_history_record(sessions, rec):
+    op = rec.get("op")
+    if op == "new":
+        sessions.append(rec["session"])
+    elif op == "del":
+        sessions[:] = [s for s in sessions if s["id"] != rec["sid"]]
+    else:
+        session = next((s for s in sessions if s["id"] == rec.get("sid")), None)
+        if session is None: return sessions
+        if op == "msg": session["messages"].append(rec["msg"])
+        elif op == "title": session["title"] = rec["title"]
+        elif op == "reset": session.update({"messages": [], "title": rec["title"]})
+    return sessions
+
+def _apply_shard_record(messages, rec):
+    if rec.get("op") == "msg": messages.append(rec["msg"])
+    return messages
+
+class SessionStore:
+    """세션별 암호화 샤드(스냅샷 + 저널)와 작은 인덱스 파일.
+
+    시작 시에는 index.dat(id, title, count, mtime)만 읽는다. 메시지는
+    해당 탭이 실제로 렌더링되거나 새 메시지를 쓸 때 샤드에서 로드한다.
+    프로세스에 하나만 두고 모든 브라우저 세션이 공유한다. 변경은 잠금 아래에서
+    한 건씩 추가되므로 동시에 써도 서로 덮어쓰지 않고, versions/generation으로
+    다른 세션의 변경을 감지한다.
+    """
+    def __init__(self, root=SESSIONS_DIR, search=None, archive_root=ARCHIVE_DIR):
+        self.root = root
+        self.search = search  # SearchIndex (선택)
+        self.index_path = os.path.join(root, "index.dat")
+        self.archive_root = archive_root
+        self.archive_index_path = os.path.join(archive_root, "index.dat")
+        self.sessions = []
+        self.archived = []  # 보관된 세션 항목 (+ "archived_at")
+        self._journals = {}
+        self._messages = {}
+        self.lock = threading.RLock()
+        self.versions = collections.defaultdict(int)  # sid -> 메시지·제목 변경 횟수
+        self.generation = 0  # 세션 목록 변경 횟수
+
+    def state_token(self):
+        """세션 목록과 각 세션 버전 — 바뀌었으면 다른 브라우저 세션이 쓴 것"""
+        with self.lock:
+            return (self.generation, tuple(self.versions[s["id"]] for s in self.sessions))
+
+    def _shard_journal(self, sid):
+        if sid not in self._journals:
+            base = os.path.join(self.root, sid)
+            self._journals[sid] = EncryptedJournal(f"{base}.dat", f"{base}.journal", _apply_shard_record, list)
+        return self._journals[sid]
+
+    def _entry(self, sid):
+        return next(s for s in self.sessions if s["id"] == sid)
+
+    def _save_index(self):
+        get_persistence().schedule(self.index_path, self._write_index)
+
+    def _write_index(self):
+        # 예약 저장(백그라운드)과 보관·복원의 즉시 저장이 같은 파일을 겹쳐 쓰지 않도록 store 잠금 아래에서 쓴다
+        with self.lock: _save_encrypted_json(self.index_path, self._index_snapshot())
+
+    def _index_snapshot(self):
+        with self.lock: return [dict(s) for s in self.sessions]
+
+    def _new_entry(self, title):
+        return {"id": str(uuid.uuid4()), "title": title, "count": 0, "mtime": time.time()}
+
+    def load(self):
+        os.makedirs(self.root, exist_ok=True)
+        os.makedirs(self.archive_root, exist_ok=True)
+        self.archived = _load_encrypted_json(self.archive_index_path, [])
+        index = _load_encrypted_json(self.index_path, None)
+        if index is None and os.path.exists(self.index_path):
+            index = self._recover_index()
+        if index is None:
+            index = self._migrate_single_file()
+        self.sessions = index or [self._new_entry("Session 1")]
+        if not index: self._save_index()
+        return self
+
+    def _recover_index(self):
+        """index.dat를 읽을 수 없을 때: 원본은 .corrupt로 보존하고 샤드 파일로부터 다시 만든다"""
+        os.replace(self.index_path, f"{self.index_path}.corrupt-{int(time.time())}")
+        sids = sorted({f.split(".")[0] for f in os.listdir(self.root) if f.endswith((".dat", ".journal")) and not f.startswith("index.")}
+                      - {a["id"] for a in self.archived})
+        self.sessions = []
+        for n, sid in enumerate(sids, 1):
+            entry = {"id": sid, "title": f"Recovered {n}", "count": len(self.messages(sid)), "mtime": time.time()}
+            self.sessions.append(entry)
+        if self.sessions: self._save_index()
+        return self.sessions or None
+
+    def _migrate_single_file(self):
+        """system_log.dat(+journal) 단일 파일 포맷을 샤드로 분할. 원본은 .migrated로 보존."""
+        if not (os.path.exists(HISTORY_FILE) or os.path.exists(HISTORY_JOURNAL_FILE)): return None
+        legacy = EncryptedJournal(HISTORY_FILE, HISTORY_JOURNAL_FILE, _apply_history_record, _new_history).load()
+        now = time.time()
+        for s in legacy:
+            base = os.path.join(self.root, s["id"])
+            _atomic_write(f"{base}.dat", encrypt_data(json.dumps({"seq": 0, "state": s["messages"]}, ensure_ascii=False), ACCESS_PASSWORD))
+        self.sessions = [{"id": s["id"], "title": s["title"], "count": len(s["messages"]), "mtime": now} for s in legacy]
+        # 원본을 치우기 전에 인덱스를 바로 쓴다 — 예약 저장을 기다리다 죽으면 샤드는 있는데 인덱스가 없다
+        self._write_index()
+        for path in (HISTORY_FILE, HISTORY_JOURNAL_FILE, f"{HISTORY_JOURNAL_FILE}.old"):
+            if os.path.exists(path): os.replace(path, f"{path}.migrated")
+        return self.sessions
+
+    def messages(self, sid):
+        """샤드를 처음 접근할 때만 복호화 (프로세스 전체에서 한 번)"""
+        with self.lock:
+            if sid not in self._messages:
+                self._messages[sid] = self._shard_journal(sid).load()
+            return self._messages[sid]
+
+    def add_message(self, sid, msg):
+        msg.setdefault("id", uuid.uuid4().hex[:12])
+        with self.lock:
+            entry = next((s for s in self.sessions if s["id"] == sid), None)
+            if entry is None: return  # 다른 브라우저 세션에서 삭제됨
+            messages = self.messages(sid)
+            messages.append(msg)
+            journal = self._shard_journal(sid)
+            journal.append({"op": "msg", "msg": msg})
+            journal.maybe_compact(lambda: list(messages))
+            entry.update({"count": len(messages), "mtime": time.time()})
+            self.versions[sid] += 1
+            self._save_index()
+            idx = len(messages) - 1
+        if self.search: self.search.add_gemini_message(sid, msg, idx)
+
+    def create(self, title):
+        with self.lock:
+            entry = self._new_entry(title)
+            self.sessions.append(entry)
+            self.generation += 1
+            self._save_index()
+        if self.search: self.search.add_title(entry["id"], title)
+        return entry
+
+    def rename(self, sid, title):
+        with self.lock:
+            self._entry(sid).update({"title": title, "mtime": time.time()})
+            self.generation += 1
+            self._save_index()
+        if self.search: self.search.add_title(sid, title)
+
+    def set_summary(self, sid, summary):
+        with self.lock:
+            self._entry(sid)["summary"] = summary
+            self._save_index()
+
+    def _drop_shard(self, sid):
+        journal = self._journals.pop(sid, None); self._messages.pop(sid, None)
+        if journal: journal.close()  # 대기 중인 스냅샷이 지운 <sid>.dat를 되살리지 않도록
+        base = os.path.join(self.root, sid)
+        for path in (f"{base}.dat", f"{base}.journal", f"{base}.journal.old"):
+            if os.path.exists(path): os.remove(path)
+
+    def delete(self, sid):
+        with self.lock:
+            self.sessions = [s for s in self.sessions if s["id"] != sid]
+            self.generation += 1
+            self._save_index()
+            self._drop_shard(sid)
+        if self.search:
+            self.search.remove_prefix(f"g|{sid}|"); self.search.remove(f"t|{sid}")
+
+    def reset(self, sid, title):
+        with self.lock:
+            self._drop_shard(sid)
+            entry = self._entry(sid)
+            entry.update({"title": title, "count": 0, "mtime": time.time()})
+            entry.pop("summary", None)
+            self.versions[sid] += 1; self.generation += 1
+            self._save_index()
+        if self.search:
+            self.search.remove_prefix(f"g|{sid}|"); self.search.add_title(sid, title)
+
+    # --- 보관 (cold tier) ---
+    def _archive_path(self, sid):
+        return os.path.join(self.archive_root, f"{sid}.z")
+
+    def _save_archive_index(self):
+        get_persistence().schedule(self.archive_index_path, self._write_archive_index)
+
+    def _write_archive_index(self):
+        with self.lock: _save_encrypted_json(self.archive_index_path, [dict(a) for a in self.archived])
+
+    def _write_indexes_now(self):
+        """보관·복원 시: 원본(샤드/blob)을 지우기 전에 두 인덱스를 바로 디스크에 쓴다.
+        디바운스 저장을 기다리면 그 사이 크래시에 어느 인덱스에도 없는 세션이 생긴다.
+        예약된 저장은 취소하고, 이미 실행 중인 저장과는 store 잠금으로 순서가 정해진다
+        (예약 작업이 잠금을 잡은 뒤 스냅샷을 뜨므로 옛 상태로 덮어쓰지 않는다)."""
+        persistence = get_persistence()
+        persistence.cancel(self.index_path); persistence.cancel(self.archive_index_path)
+        self._write_index(); self._write_archive_index()
+
+    def archive(self, sid):
+        """세션 전체를 압축·암호화한 blob 하나로 옮기고 탭·인덱스에서 뺀다"""
+        with self.lock:
+            entry = next((s for s in self.sessions if s["id"] == sid), None)
+            if entry is None or len(self.sessions) < 2: return False
+            raw = json.dumps(self.messages(sid), ensure_ascii=False).encode("utf-8")
+            _atomic_write(self._archive_path(sid), encrypt_bytes(zlib.compress(raw, 9), ACCESS_PASSWORD))
+            self.sessions = [s for s in self.sessions if s["id"] != sid]
+            self.archived.append(dict(entry, archived_at=time.time()))
+            self._write_indexes_now()
+            self._drop_shard(sid)
+            self.generation += 1
+        return True
 
-def save_tg_history():
-    data = encrypt_data(json.dumps(st.session_state.tg_messages, ensure_ascii=False), ACCESS_PASSWORD)
-    with open(TELEGRAM_HISTORY_FILE, "w", encoding="utf-8") as f: f.write(data)
+    def restore(self, sid):
+        """보관된 세션을 샤드로 풀어 다시 탭으로. 복원된 항목 반환"""
+        with self.lock:
+            entry = next((a for a in self.archived if a["id"] == sid), None)
+            if entry is None: return None
+            with open(self._archive_path(sid), "rb") as f:
+                messages = json.loads(zlib.decompress(decrypt_bytes(f.read(), ACCESS_PASSWORD)).decode("utf-8"))
+            base = os.path.join(self.root, sid)
+            _atomic_write(f"{base}.dat", encrypt_data(json.dumps({"seq": 0, "state": messages}, ensure_ascii=False), ACCESS_PASSWORD))
+            self._messages[sid] = messages
+            entry = {k: v for k, v in entry.items() if k != "archived_at"}
+            entry["mtime"] = time.time()
+            self.archived = [a for a in self.archived if a["id"] != sid]
+            self.sessions.append(entry)
+            self._write_indexes_now()
+            os.remove(self._archive_path(sid))
+            self.generation += 1
+        return entry
+
+    def archive_idle(self, idle_days=ARCHIVE_IDLE_DAYS):
+        """마지막 활동이 idle_days보다 오래된 세션을 보관 (최근 세션 하나는 항상 남김)"""
+        cutoff = time.time() - idle_days * 86400
+        with self.lock:
+            idle = [s["id"] for s in sorted(self.sessions, key=lambda s: s["mtime"])[:-1] if s["mtime"] < cutoff]
+            for sid in idle: self.archive(sid)
+        return idle
+
+    def flush(self):
+        """로드된 샤드의 저널을 즉시 스냅샷으로 압축"""
+        with self.lock:
+            for sid, messages in self._messages.items():
+                self._shard_journal(sid).maybe_compact(lambda m=messages: list(m), force=True)
+
+@st.cache_resource
+def get_session_store():
+    store = SessionStore(search=get_search_index()).load()
+    store.archive_idle()
+    return store
+
+def restore_session(sid):
+    """보관 세션 복원. blob이 없거나 깨졌으면 오류만 보여 주고 보관 항목은 그대로 둔다."""
+    try:
+        return get_session_store().restore(sid)
+    except (OSError, zlib.error, ValueError) as e:
+        st.error(f"Restore failed: {e}")
+        return None
+
+# --- 전문 검색 ---
+_WORD_RE = re.compile(r"\w+")
+
+def search_grams(text):
+    """소문자 단어를 문자 bigram으로 쪼갠다 (한 글자 단어는 그대로).
+    띄어쓰기·조사가 붙은 한국어도 부분 문자열로 찾을 수 있다."""
+    grams = set()
+    for w in _WORD_RE.findall(text.lower()):
+        if len(w) < 2: grams.add(w)
+        else: grams.update(w[i:i + 2] for i in range(len(w) - 1))
+    return grams
+
+def _encode_postings(obj):
+    if isinstance(obj, array): return base64.b64encode(obj.tobytes()).decode()
+    raise TypeError(type(obj).__name__)
+
+class SearchIndex:
+    """Gemini 메시지·세션 제목·Telegram 메시지의 역색인 (bigram → 문서 번호 배열).
+
+    변경은 저널에 한 줄씩 추가되고, 스냅샷에는 posting 배열이 base64로 저장된다.
+    수정·삭제된 문서는 tombstone(None)으로 두고 검색 시 걸러낸다.
+    """
+    def __init__(self):
+        self.docs = []  # 문서 번호 -> meta (삭제되면 None)
+        self.keys = {}  # key -> 문서 번호
+        self.postings = {}  # gram -> array("I") (문서 번호 오름차순)
+        self.built = False  # 기존 기록 전체 색인 여부
+        self.journal = None
+        self.loaded = True  # False: 스냅샷을 아직 읽지 않음 — 변경은 저널에만 쓰고 첫 검색·색인 때 읽는다
+        self.lock = threading.RLock()
+
+    @classmethod
+    def from_json(cls, data):
+        index = cls()
+        index.docs, index.built = data["docs"], data.get("built", False)
+        index.keys = {m["key"]: n for n, m in enumerate(index.docs) if m}
+        index.postings = {g: array("I", base64.b64decode(b)) for g, b in data["postings"].items()}
+        return index
+
+    def snapshot(self):
+        # 배열은 복사만 하고 base64 변환은 백그라운드 저장 시(_encode_postings)
+        self._purge()
+        return {"docs": list(self.docs), "postings": {g: a[:] for g, a in self.postings.items()}, "built": self.built}
+
+    def _purge(self):
+        """tombstone이 문서의 1/4을 넘으면 살아 있는 문서만 다시 번호를 매기고 posting을 다시 만든다.
+        저널 레코드는 문서 번호가 아니라 key를 쓰므로 번호가 바뀌어도 재생에 문제없다."""
+        if (len(self.docs) - len(self.keys)) * 4 <= len(self.docs): return
+        renum, docs = {}, []
+        for n, meta in enumerate(self.docs):
+            if meta is not None: renum[n] = len(docs); docs.append(meta)
+        postings = {}
+        for g, posting in self.postings.items():
+            live = array("I", (renum[d] for d in posting if d in renum))
+            if live: postings[g] = live
+        self.docs, self.postings = docs, postings
+        self.keys = {meta["key"]: n for n, meta in enumerate(docs)}
+
+    def _remove(self, key):
+        doc = self.keys.pop(key, None)
+        if doc is not None: self.docs[doc] = None
+
+    def _add(self, key, text, meta):
+        self._remove(key)
+        doc = len(self.docs)
+        self.docs.append(dict(meta, key=key, p=" ".join(text.split())[:120]))
+        self.keys[key] = doc
+        for g in search_grams(text):
+            posting = self.postings.get(g)
+            if posting is None: posting = self.postings[g] = array("I")
+            posting.append(doc)
+
+    def ensure_loaded(self):
+        """스냅샷 + 저널(읽기 전에 쓴 레코드 포함)을 재생. 첫 검색·색인 때 한 번"""
+        with self.lock:
+            if self.loaded: return
+            with get_metrics().span("search.load"):
+                state = self.journal.load()
+            self.docs, self.keys, self.postings, self.built = state.docs, state.keys, state.postings, state.built
+            self.loaded = True
+
+    def _log(self, rec):
+        with self.lock:
+            if not self.loaded and not self.journal.resumed:
+                # 저널만으로 seq를 알 수 없으면(이전 버전 저널) 여기서 읽는다
+                self.journal.resumed = self.journal.resume()
+                if not self.journal.resumed: self.ensure_loaded()
+            if self.loaded: _apply_search_record(self, rec)
+            if self.journal:
+                self.journal.append(rec)
+                # 읽기 전이라도 저널이 압축 임계값에 이르면 한 번 읽어 압축한다
+                if not self.loaded and self.journal.pending >= JOURNAL_COMPACT_EVERY: self.ensure_loaded()
+                if self.loaded: self.journal.maybe_compact(self.snapshot)
+
+    def add(self, key, text, meta):
+        self._log({"op": "add", "key": key, "text": text, "meta": meta})
+
+    def remove(self, key):
+        # 읽기 전에는 있는지 모르므로 그냥 기록 (재생 시 없으면 무시됨)
+        if not self.loaded or key in self.keys: self._log({"op": "remove", "key": key})
+
+    def remove_prefix(self, prefix):
+        if not self.loaded or any(k.startswith(prefix) for k in self.keys): self._log({"op": "drop", "prefix": prefix})
+
+    def add_gemini_message(self, sid, msg, idx):
+        mid = msg.get("id") or f"#{idx}"
+        self.add(f"g|{sid}|{mid}", msg["content"], {"kind": "g", "sid": sid, "mid": mid, "idx": idx, "role": msg["role"]})
+
+    def add_title(self, sid, title):
+        self.add(f"t|{sid}", title, {"kind": "t", "sid": sid})
+
+    def add_tg_message(self, dialog, msg):
+        self.add(f"tg|{dialog}|{msg['id']}", msg.get("text", ""),
+                 {"kind": "tg", "dialog": dialog, "mid": msg["id"], "date": msg.get("date_full", "")})
+
+    def build(self, store, tg_logs):
+        """기존 기록 전체를 한 번 색인. 레코드별 저널 대신 끝에 스냅샷 한 번. tg_logs: [(대화, 메시지 리스트)]"""
+        with self.lock:
+            self.ensure_loaded()
+            if not self.built: self._build(store, tg_logs)
+
+    def _build(self, store, tg_logs):
+        journal, self.journal = self.journal, None
+        for entry in store.sessions:
+            self.add_title(entry["id"], entry["title"])
+            for idx, msg in enumerate(store.messages(entry["id"])):
+                self.add_gemini_message(entry["id"], msg, idx)
+        for dialog, msgs in tg_logs:
+            for msg in msgs: self.add_tg_message(dialog, msg)
+        self.journal = journal
+        # 색인한 문서가 스냅샷으로 디스크에 있어야만 built — 쓰기에 실패하면 다음에 다시 색인
+        if journal: journal.compact_now(lambda: dict(self.snapshot(), built=True))
+        self.built = True
+
+    def rekey_tg(self, dialog, msgs):
+        """대화 구분 이전에 색인된 Telegram 메시지(tg|<id>)를 dialog 키로 옮긴다. 저널 레코드 한 줄."""
+        with self.lock:
+            self.ensure_loaded()
+            ids = [m["id"] for m in msgs if f"tg|{m['id']}" in self.keys]
+            if ids: self._log({"op": "rekey", "dialog": dialog, "ids": ids})
+
+    def search(self, query, limit=SEARCH_RESULT_LIMIT):
+        """[(score, meta)] — 모든 gram을 포함한 문서 우선(최신순), 없으면 일치한 gram의 idf 합 순"""
+        with self.lock:
+            self.ensure_loaded()
+            return self._search(search_grams(query), limit)
+
+    def _search(self, grams, limit):
+        present = sorted((g for g in grams if g in self.postings), key=lambda g: len(self.postings[g]))
+        if not present: return []
+        live = max(1, len(self.keys))
+        idf = {g: math.log(1 + live / len(self.postings[g])) for g in present}
+        scores = {}
+        if len(present) == len(grams):
+            cand = set(self.postings[present[0]])
+            for g in present[1:]:
+                cand.intersection_update(self.postings[g])
+                if not cand: break
+            scores = {doc: sum(idf.values()) for doc in cand if self.docs[doc] is not None}
+        if not scores:
+            for g in present:
+                for doc in self.postings[g]: scores[doc] = scores.get(doc, 0.0) + idf[g]
+        ranked = heapq.nlargest(limit, ((score, doc) for doc, score in scores.items() if self.docs[doc] is not None))
+        return [(score, self.docs[doc]) for score, doc in ranked]
+
+def _apply_search_record(index, rec):
+    op = rec.get("op")
+    if op == "add": index._add(rec["key"], rec["text"], rec["meta"])
+    elif op == "remove": index._remove(rec["key"])
+    elif op == "drop":
+        for key in [k for k in index.keys if k.startswith(rec["prefix"])]: index._remove(key)
+    elif op == "rekey":
+        for mid in rec["ids"]:
+            doc = index.keys.pop(f"tg|{mid}", None)
+            key = f"tg|{rec['dialog']}|{mid}"
+            if doc is None: continue
+            if key in index.keys: index.docs[doc] = None; continue  # 이미 대화 키로 색인됨
+            index.docs[doc] = dict(index.docs[doc], key=key, dialog=rec["dialog"])
+            index.keys[key] = doc
+    elif op == "built": index.built = True  # 스냅샷 built 플래그 도입 이전 저널
+    return index
+
+def load_search_index():
+    journal = EncryptedJournal(SEARCH_INDEX_FILE, SEARCH_JOURNAL_FILE, _apply_search_record, SearchIndex,
+                               decode_fn=SearchIndex.from_json, encode_default=_encode_postings)
+    # 스냅샷은 첫 검색·색인 때 읽는다 (시작 시 복호화 비용이 세션 인덱스보다 훨씬 크다)
+    index = SearchIndex()
+    index.journal, index.loaded = journal, False
+    return index
+
+@st.cache_resource
+def get_search_index():
+    return load_search_index()
+
+def jump_to_search_hit(meta):
+    """검색 결과 클릭: 해당 탭을 열고, 메시지가 렌더링 창에 들어오게 넓힌 뒤 강조 표시"""
+    if meta["kind"] == "tg":
+        st.session_state.goto_tab = "tg"
+        dialogs = tg_dialogs()
+        dialog = meta.get("dialog") or (dialogs[0] if dialogs else None)  # 대화 구분 이전 색인은 첫 대화
+        if dialog not in dialogs: return
+        if len(dialogs) > 1: st.session_state.tg_dialog_tabs = dialog
+        ids = [m["id"] for m in get_tg_log(dialog).messages]
+        if meta["mid"] in ids:
+            windows = st.session_state.setdefault("tg_render_windows", {})
+            windows[dialog] = max(windows.get(dialog, TG_RENDER_WINDOW), len(ids) - ids.index(meta["mid"]))
+    else:
+        store = get_session_store()
+        entry = next((s for s in store.sessions if s["id"] == meta["sid"]), None) or restore_session(meta["sid"])
+        if entry is None: return
+        st.session_state.goto_tab = entry["id"]
+        if meta["kind"] == "g":
+            windows = st.session_state.setdefault("render_windows", {})
+            windows[entry["id"]] = max(windows.get(entry["id"], GEMINI_RENDER_WINDOW), entry["count"] - meta["idx"])
+    st.session_state.search_focus = meta
+
+def _apply_tg_record(messages, rec):
+    if rec.get("op") == "upsert": merge_tg_messages(messages, rec["msgs"])
+    elif rec.get("op") == "clear": messages.clear()
+    return messages
+
+class TelegramLog:
+    """Telegram 대화(봇) 하나의 기록 (프로세스 공유).
+
+    모든 브라우저 세션이 같은 리스트를 읽고, 변경은 잠금 아래에서 병합·저널 기록한다.
+    여러 세션이 같은 라이브 업데이트를 받아도 이미 있는 메시지는 다시 기록하지 않는다.
+    """
+    _adopt_lock = threading.Lock()
+
+    def __init__(self, dialog, root=TELEGRAM_DIALOG_DIR):
+        self.dialog = dialog
+        os.makedirs(root, exist_ok=True)
+        base = os.path.join(root, re.sub(r"[^\w@-]", "_", dialog))
+        adopted = self._adopt_legacy(base)
+        self.journal = EncryptedJournal(f"{base}.dat", f"{base}.journal", _apply_tg_record, list)
+        self.messages = self.journal.load()
+        self.lock = threading.RLock()
+        self.version = 0  # 변경될 때마다 증가
+        # 동기화 watermark: 성공한 증분 조회가 받은 최대 id. 전송·라이브 이벤트로 먼저 들어온
+        # 메시지는 올리지 않으므로, 그보다 작은 id의 아직 못 받은 답장을 건너뛰지 않는다.
+        self.sync_path = f"{base}.sync"
+        synced = _load_encrypted_json(self.sync_path, None)
+        # .sync가 없는 이전 버전 기록은 마지막 메시지 id에서 이어간다
+        self.synced = synced["synced"] if synced else (self.messages[-1]["id"] if self.messages else 0)
+        if adopted: get_search_index().rekey_tg(dialog, self.messages)
+
+    @classmethod
+    def _adopt_legacy(cls, base):
+        """대화별 기록 이전의 단일 기록은 처음 여는 대화(설정 목록의 첫 번째)로 옮긴다"""
+        with cls._adopt_lock:
+            if os.path.exists(f"{base}.dat") or os.path.exists(f"{base}.journal"): return False
+            adopted = False
+            for src, dst in ((TELEGRAM_HISTORY_FILE, f"{base}.dat"), (TELEGRAM_JOURNAL_FILE, f"{base}.journal")):
+                if os.path.exists(src): os.replace(src, dst); adopted = True
+            return adopted
+
+    def _is_known(self, msg):
+        pos = bisect.bisect_left(self.messages, msg["id"], key=lambda m: m["id"])
+        return pos < len(self.messages) and self.messages[pos] == msg
+
+    def append(self, op, **fields):
+        with self.lock:
+            if op == "upsert":
+                fields["msgs"] = [m for m in fields["msgs"] if not self._is_known(m)]
+                if not fields["msgs"]: return
+            rec = dict(op=op, **fields)
+            _apply_tg_record(self.messages, rec)
+            self.journal.append(rec)
+            self.journal.maybe_compact(lambda: list(self.messages))
+            self.version += 1
+            if op == "clear": self._save_synced(0)
+        index = get_search_index()
+        if op == "upsert":
+            for msg in rec["msgs"]: index.add_tg_message(self.dialog, msg)
+        elif op == "clear": index.remove_prefix(f"tg|{self.dialog}|")
+
+    def mark_synced(self, upto):
+        """증분 조회가 성공한 뒤에만 호출 — watermark는 앞으로만 움직인다"""
+        with self.lock:
+            if upto > self.synced: self._save_synced(upto)
+
+    def _save_synced(self, upto):
+        # 저널보다 늦게 써지므로 크래시 후에는 watermark가 뒤처질 뿐 (다시 받은 메시지는 _is_known으로 걸러짐)
+        self.synced = upto
+        schedule_encrypted_json(self.sync_path, lambda: {"synced": self.synced})
+
+    def compact(self):
+        with self.lock:
+            self.journal.maybe_compact(lambda: list(self.messages), force=True)
+
+@st.cache_resource
+def get_tg_log(dialog):
+    return TelegramLog(dialog)
+
+def load_tg_history(dialog):
+    return get_tg_log(dialog).messages
+
+def shared_state_token():
+    # Telegram 기록은 이 브라우저 세션이 Telegram 탭을 연 뒤에만 로드·감시
+    return (get_session_store().state_token(), tuple(get_tg_log(d).version for d in st.session_state.get("tg_loaded", ())))
+
+@st.fragment(run_every=2)
+def shared_state_watch():
+    # 다른 브라우저 세션이 기록을 바꿨으면 전체 rerun (같은 공유 객체를 다시 읽기만 하면 됨)
+    if st.session_state.get("shared_state_token") != shared_state_token(): st.rerun()
+
+def append_tg_history(dialog, op, **fields):
+    """동기화된 변경분(delta)만 대화의 공유 기록에 병합하고 저널에 추가"""
+    get_tg_log(dialog).append(op, **fields)
+
+def save_tg_history(dialog):
+    """저널을 즉시 스냅샷으로 압축"""
+    get_tg_log(dialog).compact()
 
 check_password()
+mark_phase("auth")
+page_start = time.perf_counter()
 
 # --- 세션 초기화 ---
+store = get_session_store()
+st.session_state.shared_state_token = shared_state_token()
+shared_state_watch()
+mark_phase("store")
+
 defaults = {
-    "sessions": load_history(), "api_key": "", "model_options": None,
+    "api_key": "", "model_options": None,
     "tg_api_id": "", "tg_api_hash": "", "tg_phone": "", "tg_bot_username": "",
     "tg_auth_status": "NOT_STARTED", "tg_code_hash": "",
-    "tg_messages": load_tg_history(), "tg_pending_refresh": False
+    "tg_pending_refresh": False
 }
 for k, v in defaults.items():
     if k not in st.session_state:
@@ -347,11 +2015,18 @@ with st.sidebar:
     
     with st.expander("🤖 Gemini", expanded=not bool(st.session_state.api_key)):
         st.session_state.api_key = st.text_input("API Key", value=st.session_state.api_key, type="password", label_visibility="collapsed", placeholder="Gemini API Key")
+        n_req, p50, p95 = get_gemini_client().latency_summary()
+        if n_req: st.caption(f"⏱ {n_req} req · p50 {p50*1000:.0f}ms · p95 {p95*1000:.0f}ms")
+    
+    # 키가 바뀌면 캐시에서 바로 모델 목록을 채움 (캐시에 없을 때만 네트워크)
+    if st.session_state.api_key and st.session_state.get("model_options_key") != st.session_state.api_key:
+        st.session_state.model_options_key = st.session_state.api_key
+        st.session_state.model_options = fetch_available_models(st.session_state.api_key)
     
     if st.button("🔄 Refresh Models", use_container_width=True):
         if st.session_state.api_key:
             with st.spinner("Loading..."):
-                st.session_state.model_options = fetch_available_models(st.session_state.api_key)
+                st.session_state.model_options = fetch_available_models(st.session_state.api_key, force=True)
             if st.session_state.model_options: st.success("✅ Loaded")
             else: st.error("Failed")
         else: st.warning("Enter API Key")
@@ -361,16 +2036,28 @@ with st.sidebar:
         model_list = st.session_state.model_options[cat]
         sel_disp = st.selectbox("Model", options=[m[1] for m in model_list])
         selected_model_id = [m[0] for m in model_list if m[1] == sel_disp][0]
+        all_model_ids = [m[0] for models in st.session_state.model_options.values() for m in models]
+        fanout_models = st.multiselect("🔀 Fan-out", options=all_model_ids, placeholder="Compare models...",
+                                       help="2개 이상 선택하면 같은 프롬프트를 모두에게 동시에 보냅니다")
     else:
         st.caption("Click Refresh to load")
         selected_model_id = "gemini-1.5-flash"
+        fanout_models = []
 
     use_google_search = st.toggle("🌐 Google Search", value=False)
+    use_streaming = st.toggle("⚡ Stream", value=True)
     
     with st.expander("⚙️ Parameters"):
         chat_window_height = st.slider("Chat Height", 400, 2000, 850, step=50)
         temperature = st.slider("Temperature", 0.0, 2.0, 0.7)
         system_prompt = st.text_area("System Prompt", height=80, placeholder="Optional...")
+        summarize_older_turns = st.toggle("Summarize older turns", value=False)
+        verify_tokens = st.toggle("Verify with countTokens", value=False)
+        use_response_cache = st.toggle("♻️ Cache deterministic replies", value=False,
+                                       help="temperature 0 + Google Search off: reuse the stored answer for an identical request")
+        if use_response_cache:
+            rc = get_response_cache().stats()
+            st.caption(f"♻️ {rc['hits']} hits · {rc['misses']} misses ({rc['hit_rate']:.0%}) · {rc['entries']} entries · {rc['bytes'] / 1024:.0f} KB")
 
     st.markdown("---")
     
@@ -378,7 +2065,8 @@ with st.sidebar:
         st.session_state.tg_api_id = st.text_input("API ID", value=st.session_state.tg_api_id, type="password", key="sb_tid")
         st.session_state.tg_api_hash = st.text_input("API Hash", value=st.session_state.tg_api_hash, type="password", key="sb_thash")
         st.session_state.tg_phone = st.text_input("Phone", value=st.session_state.tg_phone, placeholder="+821012345678", key="sb_tphone")
-        st.session_state.tg_bot_username = st.text_input("Bot", value=st.session_state.tg_bot_username, placeholder="@my_bot", key="sb_tbot")
+        st.session_state.tg_bot_username = st.text_input("Bots", value=st.session_state.tg_bot_username, placeholder="@bot_a, @bot_b", key="sb_tbot",
+                                                         help="One tab per bot or chat; separate with commas")
         
         if st.session_state.tg_auth_status == "AUTHORIZED":
             st.success("✅ Connected")
@@ -400,90 +2088,249 @@ with st.sidebar:
             except Exception as e:
                 st.error(f"❌ {str(e)}")
 
+    with st.expander("🔎 Search", expanded=False):
+        query = st.text_input("Search", key="search_query", placeholder="Search all history...", label_visibility="collapsed")
+        if query.strip():
+            index = get_search_index()
+            index.ensure_loaded()
+            if not index.built:
+                try:
+                    with st.spinner("Indexing history..."): index.build(store, [(d, load_tg_history(d)) for d in tg_dialogs()])
+                except OSError as e: st.warning(f"Index not saved: {e}")
+            t0 = time.perf_counter()
+            hits = index.search(query)
+            st.caption(f"{len(hits)} hits · {(time.perf_counter() - t0) * 1000:.1f}ms")
+            titles = {s["id"]: s["title"] for s in store.sessions}
+            for n, (score, meta) in enumerate(hits):
+                where = f"📱 {meta.get('dialog', '')}".rstrip() if meta["kind"] == "tg" else titles.get(meta.get("sid"), "?")
+                st.button(f"{where} · {meta['p'][:60]}", key=f"search_hit_{n}", on_click=jump_to_search_hit, args=(meta,), use_container_width=True)
+
+    with st.expander("📊 Performance", expanded=False):
+        metrics = get_metrics()
+        rows = metrics.summary()
+        if rows:
+            # st.dataframe은 첫 호출에 pandas/pyarrow를 불러와 콜드 스타트가 수백 ms 늘어나므로 markdown 표로
+            st.markdown("| span | n | p50 | p95 | p99 | max |\n|---|--:|--:|--:|--:|--:|\n" + "\n".join(
+                f"| {n} | {c} | {p50:.1f} | {p95:.1f} | {p99:.1f} | {mx:.1f} |" for n, c, p50, p95, p99, mx in rows))
+            st.caption("ms · recent spans across all sessions")
+        else:
+            st.caption("No measurements yet")
+        log_on = st.toggle(f"Append to {METRICS_FILE}", value=bool(metrics.path), key="metrics_jsonl")
+        metrics.path = METRICS_FILE if log_on else None
+        if st.button("Reset", key="metrics_reset", use_container_width=True):
+            metrics.reset(); st.rerun()
+        if st.session_state.get("cold_start_phases"):
+            st.caption(f"🚀 First run: {phases_text(st.session_state.cold_start_phases)}")
+        if st.session_state.get("last_run_phases"):
+            st.caption(f"↻ Last run: {phases_text(st.session_state.last_run_phases)}")
+
     st.markdown("---")
     c1, c2 = st.columns(2)
     if c1.button("➕ New", use_container_width=True):
-        st.session_state.sessions.append({"id": str(uuid.uuid4()), "title": f"Session {len(st.session_state.sessions)+1}", "messages": []})
-        save_history(); st.rerun()
+        store.create(f"Session {len(store.sessions)+1}")
+        st.rerun()
     if c2.button("🗑️ Del", use_container_width=True):
-        if len(st.session_state.sessions) > 1: st.session_state.sessions.pop()
-        else: st.session_state.sessions[0].update({"messages": [], "title": "Session 1"})
-        save_history(); st.rerun()
+        if len(store.sessions) > 1: store.delete(store.sessions[-1]["id"])
+        else: store.reset(store.sessions[0]["id"], "Session 1")
+        st.rerun()
+    if store.archived:
+        with st.expander(f"🗄️ Archived ({len(store.archived)})", expanded=False):
+            for entry in sorted(store.archived, key=lambda a: -a["mtime"]):
+                label = f"↩️ {entry['title']} · {datetime.fromtimestamp(entry['mtime']):%Y-%m-%d} · {entry['count']}"
+                if st.button(label, key=f"restore_{entry['id']}", use_container_width=True):
+                    restored = restore_session(entry["id"])
+                    if restored:
+                        st.session_state.goto_tab = restored["id"]; st.rerun()
     if st.button("🔒 Lock", use_container_width=True):
+        store.flush()
+        for dialog in st.session_state.get("tg_loaded", ()): save_tg_history(dialog)
+        get_persistence().flush()
         st.session_state.authenticated = False; st.rerun()
 
 
+mark_phase("sidebar")
+
 # --- 6. 메인 ---
-tab_names = [s["title"] for s in st.session_state.sessions] + ["📱 Telegram"]
-tabs = st.tabs(tab_names)
+TG_TAB_LABEL = "📱 Telegram"
+
+def session_tab_labels(sessions):
+    """세션 제목으로 탭 이름. 같은 제목(또는 Telegram 탭 이름)이 있으면 " (2)", " (3)"…을 붙여 유일하게"""
+    labels, seen = [], {TG_TAB_LABEL}
+    for s in sessions:
+        label, n = s["title"], 1
+        while label in seen:
+            n += 1; label = f"{s['title']} ({n})"
+        seen.add(label); labels.append(label)
+    return labels
+
+# 다른 브라우저 세션이 도중에 세션을 지우거나 보관해도 탭과 세션이 어긋나지 않게 한 번만 복사
+with store.lock: sessions = [dict(s) for s in store.sessions]
+tab_ids = [s["id"] for s in sessions] + ["tg"]
+tab_names = session_tab_labels(sessions) + [TG_TAB_LABEL]
+# 탭 이름이 바뀌면(이름 변경·새 세션·복원) 탭 위젯이 새로 만들어져 첫 탭으로 돌아가므로,
+# 이동 요청(goto_tab)이 있으면 그 탭을, 없으면 보던 탭을 다시 선택
+target = st.session_state.pop("goto_tab", None)
+if target is None and st.session_state.get("tab_names") != tab_names: target = st.session_state.get("view_tab")
+if target in tab_ids: st.session_state.main_tabs = tab_names[tab_ids.index(target)]
+st.session_state.tab_names = tab_names
+# 선택 상태를 추적해 비활성 탭은 렌더링(및 샤드 로드)하지 않음
+tabs = st.tabs(tab_names, key="main_tabs", on_change="rerun")
+selected = st.session_state.get("main_tabs")
+st.session_state.view_tab = tab_ids[tab_names.index(selected)] if selected in tab_names else tab_ids[0]
 
 # === Gemini 탭 ===
-for i in range(len(st.session_state.sessions)):
+for i, session in enumerate(sessions):
+    if tabs[i].open is False: continue
     with tabs[i]:
-        session = st.session_state.sessions[i]
+        messages = store.messages(session["id"])
         with st.expander("✏️ Rename", expanded=False):
             new_title = st.text_input("", value=session["title"], key=f"title_{session['id']}", label_visibility="collapsed")
             if new_title != session["title"]:
-                session["title"] = new_title; save_history(); st.rerun()
+                store.rename(session["id"], new_title); st.rerun()
+            if len(sessions) > 1 and st.button("🗄️ Archive", key=f"archive_{session['id']}"):
+                store.archive(session["id"]); st.rerun()
 
         st.caption(f"🤖 {selected_model_id}")
         chat_container = st.container(height=chat_window_height, border=False)
         
-        with chat_container:
-            if not session["messages"]:
+        with chat_container, get_metrics().span("render.gemini_tab"):
+            if not messages:
                 st.markdown('<div class="empty-state"><div class="icon">🤖</div><div class="title">Start a conversation</div><div class="sub">Type a message below</div></div>', unsafe_allow_html=True)
-            for idx, msg in enumerate(session["messages"]):
+            # 최근 N개만 렌더링, 이전 메시지는 요청 시 페이지 단위로
+            windows = st.session_state.setdefault("render_windows", {})
+            start = max(0, len(messages) - windows.get(session["id"], GEMINI_RENDER_WINDOW))
+            if start and st.button(f"⏫ Load older ({start} more)", key=f"older_{session['id']}", use_container_width=True):
+                windows[session["id"]] = len(messages) - start + GEMINI_RENDER_PAGE; st.rerun()
+            frags = get_fragment_cache()
+            focus = st.session_state.get("search_focus") or {}
+            def render_message_body(msg, bid):
+                if msg.get("model"): st.caption(f"🤖 {msg['model']} · ⏱ {msg.get('latency', 0):.1f}s")
+                if msg.get("cached"): st.caption("♻️ cached reply")
+                if msg["role"] == "assistant":
+                    st.markdown(frags.get(("copy", bid, hash(msg["content"])), lambda: copy_buttons_html(bid, msg["content"])), unsafe_allow_html=True)
+                st.markdown(msg["content"])
+                if msg.get("sources"):
+                    st.markdown(frags.get(("src", bid, hash(msg["content"])), lambda: sources_html(msg["sources"])), unsafe_allow_html=True)
+            idx = start
+            while idx < len(messages):
+                msg = messages[idx]
+                # 멀티 모델 응답 묶음은 한 말풍선 안에 나란히
+                group = 1
+                while msg.get("fanout") and idx + group < len(messages) and messages[idx + group].get("fanout") == msg["fanout"]:
+                    group += 1
                 with st.chat_message(msg["role"], avatar="🧑‍💻" if msg["role"]=="user" else "🤖"):
-                    if msg["role"] == "assistant":
-                        b64 = base64.b64encode(msg["content"].encode('utf-8')).decode('utf-8')
-                        bm, bt = f"c_m_{idx}_{i}", f"c_t_{idx}_{i}"
-                        st.markdown(f'<div class="copy-btn-wrapper"><button id="{bm}" class="custom-copy-btn" onclick="copyBase64(\'{b64}\',\'{bm}\',\'md\')">📋 MD</button><button id="{bt}" class="custom-copy-btn" onclick="copyBase64(\'{b64}\',\'{bt}\',\'txt\')">📝 TXT</button></div>', unsafe_allow_html=True)
-                    st.markdown(msg["content"])
-                    if msg.get("sources"):
-                        st.markdown("<div class='source-box'>📚 <b>Sources:</b><br>" + "".join([f"• <a href='{s['uri']}' target='_blank'>{s.get('title','Link')}</a><br>" for s in msg["sources"]]) + "</div>", unsafe_allow_html=True)
+                    cols = st.columns(group) if group > 1 else [st.container()]
+                    for k, col in zip(range(idx, idx + group), cols):
+                        if focus.get("sid") == session["id"] and focus.get("mid") == (messages[k].get("id") or f"#{k}"):
+                            col.caption("🔎 Search hit")
+                        with col: render_message_body(messages[k], messages[k].get("id") or f"{k}_{i}")
+                idx += group
 
         if prompt := st.chat_input("Message...", key=f"input_{session['id']}"):
             if not st.session_state.api_key:
                 st.error("⚠️ API Key required"); st.stop()
-            session["messages"].append({"role": "user", "content": prompt})
-            save_history()
+            store.add_message(session["id"], {"role": "user", "content": prompt, "tokens": estimate_tokens(prompt)})
             with chat_container:
                 with st.chat_message("assistant", avatar="🤖"):
                     ph = st.empty()
                     ph.markdown("⏳ *Thinking...*")
                     try:
-                        url = f"https://generativelanguage.googleapis.com/v1beta/models/{selected_model_id}:generateContent?key={st.session_state.api_key}"
-                        contents = [{"role": "user" if m["role"]=="user" else "model", "parts": [{"text": m["content"]}]} for m in session["messages"][-15:]]
+                        # 멀티 모델이면 같은 contents를 모두에게 보내므로 예산이 가장 작은 모델에 맞춘다 (토큰 검증도 그 모델로)
+                        budget_model = min(fanout_models, key=context_budget) if len(fanout_models) > 1 else selected_model_id
+                        budget = context_budget(budget_model)
+                        scale = st.session_state.get("token_scale", 1.0)
+                        contents, cut = build_context(messages, budget, scale)
+                        if verify_tokens:
+                            # 실제 토큰 수로 추정 배율을 보정하고, 예산을 넘었으면 다시 채운다
+                            actual = count_tokens_remote(budget_model, st.session_state.api_key, contents)
+                            estimated = sum(message_tokens(m) for k, m in enumerate(messages[cut:], cut) if not _is_fanout_sibling(messages, k))
+                            if actual:
+                                scale = st.session_state.token_scale = actual / estimated
+                                if actual > budget: contents, cut = build_context(messages, budget, scale)
+                        instruction = system_prompt.strip()
+                        if summarize_older_turns and cut:
+                            summary = summarize_older(session.get("summary"), messages, cut, st.session_state.api_key)
+                            if summary is not session.get("summary"): store.set_summary(session["id"], summary)
+                            if summary["text"]: instruction += f"\n\nSummary of the earlier conversation:\n{summary['text']}"
                         payload = {"contents": contents, "generationConfig": {"temperature": temperature, "maxOutputTokens": 8192}}
-                        if system_prompt.strip(): payload["systemInstruction"] = {"parts": [{"text": system_prompt}]}
+                        if instruction.strip(): payload["systemInstruction"] = {"parts": [{"text": instruction.strip()}]}
                         if use_google_search: payload["tools"] = [{"google_search": {}}]
-                        res = requests.post(url, headers={'Content-Type':'application/json'}, data=json.dumps(payload))
-                        if res.status_code == 200:
-                            result = res.json()
-                            if "candidates" in result:
-                                cand = result["candidates"][0]
-                                bot_text = cand["content"]["parts"][0]["text"]
-                                sources = []
-                                g_meta = cand.get("groundingMetadata", {})
-                                if "groundingChunks" in g_meta:
-                                    for chunk in g_meta["groundingChunks"]:
-                                        if "web" in chunk: sources.append(chunk["web"])
-                                session["messages"].append({"role": "assistant", "content": bot_text, "sources": sources})
-                                save_history(); st.rerun()
-                            else: ph.error("No response")
+                        cache = get_response_cache() if use_response_cache and ResponseCache.cacheable(payload) else None
+                        if len(fanout_models) > 1:
+                            # 같은 payload를 여러 모델에 동시에 — 전체 소요 ≈ 가장 느린 모델 1개
+                            ph.empty()
+                            slots = {}
+                            for col, m_id in zip(st.columns(len(fanout_models)), fanout_models):
+                                col.caption(f"🤖 {m_id}")
+                                slots[m_id] = col.empty()
+                                slots[m_id].markdown("⏳ *Thinking...*")
+                            client, results, cached = get_gemini_client(), {}, set()
+                            for m_id in fanout_models:
+                                hit = cache.get(m_id, payload) if cache else None
+                                if hit:
+                                    results[m_id] = (hit["text"], hit["sources"], None, 0.0); cached.add(m_id)
+                                    slots[m_id].markdown(f"{hit['text']}\n\n*♻️ cached*")
+                            pending = [m_id for m_id in fanout_models if m_id not in results]
+                            with ThreadPoolExecutor(max_workers=max(1, min(FANOUT_MAX_WORKERS, len(pending)))) as pool:
+                                futures = {pool.submit(gemini_generate, client, m_id, st.session_state.api_key, payload): m_id for m_id in pending}
+                                for fut in as_completed(futures):
+                                    m_id = futures[fut]
+                                    text, sources, error, elapsed = results[m_id] = fut.result()
+                                    if error: slots[m_id].error(f"{error} · {elapsed:.1f}s")
+                                    else: slots[m_id].markdown(f"{text}\n\n*⏱ {elapsed:.1f}s*")
+                                    if cache and not error: cache.put(m_id, payload, text, sources)
+                            group = uuid.uuid4().hex[:12]
+                            for m_id in fanout_models:
+                                text, sources, error, elapsed = results[m_id]
+                                if text:
+                                    msg = {"role": "assistant", "content": text, "sources": sources, "tokens": estimate_tokens(text),
+                                           "model": m_id, "latency": round(elapsed, 2), "fanout": group}
+                                    if m_id in cached: msg["cached"] = True
+                                    store.add_message(session["id"], msg)
+                            if any(r[0] for r in results.values()): st.rerun()
                         else:
-                            err = res.json().get("error",{}).get("message","Unknown")
-                            ph.error(f"Error {res.status_code}: {err}")
+                            hit = cache.get(selected_model_id, payload) if cache else None
+                            if hit:
+                                store.add_message(session["id"], {"role": "assistant", "content": hit["text"], "sources": hit["sources"],
+                                                                  "tokens": estimate_tokens(hit["text"]), "cached": True})
+                                st.rerun()
+                            method, params = ("streamGenerateContent", {"alt": "sse"}) if use_streaming else ("generateContent", None)
+                            reply_start = time.perf_counter()
+                            res = get_gemini_client().post(f"models/{selected_model_id}:{method}", st.session_state.api_key, payload,
+                                                           params=params, stream=use_streaming)
+                            if res.status_code == 200:
+                                cands = iter_gemini_stream(res) if use_streaming else res.json().get("candidates", [])[:1]
+                                bot_text, sources = "", []
+                                for cand in cands:
+                                    bot_text += gemini_candidate_text(cand)
+                                    # grounding 정보는 마지막 청크에 실려 옴
+                                    sources = gemini_candidate_sources(cand) or sources
+                                    if use_streaming: ph.markdown(bot_text + " ▌")
+                                # 요청부터 마지막 청크까지 (gemini.<method>는 헤더 도착까지)
+                                get_metrics().record("gemini.reply", time.perf_counter() - reply_start, model=selected_model_id)
+                                if bot_text:
+                                    if cache: cache.put(selected_model_id, payload, bot_text, sources)
+                                    store.add_message(session["id"], {"role": "assistant", "content": bot_text, "sources": sources,
+                                                                      "tokens": estimate_tokens(bot_text)})
+                                    st.rerun()
+                                else: ph.error("No response")
+                            else:
+                                err = res.json().get("error",{}).get("message","Unknown")
+                                ph.error(f"Error {res.status_code}: {err}")
                     except Exception as e:
                         ph.error(f"Exception: {str(e)}")
 
 
+mark_phase("gemini")
+
 # === Telegram 탭 ===
 with tabs[-1]:
     tg_ok = all([st.session_state.tg_api_id, st.session_state.tg_api_hash,
-                 st.session_state.tg_phone, st.session_state.tg_bot_username])
+                 st.session_state.tg_phone, tg_dialogs()])
     
-    if not tg_ok:
+    if tabs[-1].open is False:
+        pass  # 닫힌 탭 — Telegram 기록도 로드하지 않음
+    elif not tg_ok:
         st.markdown("""<div class="empty-state"><div class="icon">📱</div>
             <div class="title">Telegram Setup Required</div>
             <div class="sub">Configure credentials in sidebar → 📱 Telegram</div>
@@ -516,33 +2363,32 @@ with tabs[-1]:
     
     else:
         # === Telegram 채팅 UI ===
-        bot_name = st.session_state.tg_bot_username
-        
-        # 헤더
-        st.markdown(f"""<div class="tg-header">
-            <div class="tg-avatar">🤖</div>
-            <div class="tg-bot-info">
-                <div class="name">{bot_name}</div>
-                <div class="status">● online</div>
-            </div>
-        </div>""", unsafe_allow_html=True)
+        dialogs = tg_dialogs()
+        st.session_state.tg_loaded = dialogs  # 이 세션이 보는 대화 (공유 기록 감시 대상)
         
-        # 툴바
-        tc1, tc2, tc3, tc4 = st.columns([1, 1, 1.5, 4])
+        # 툴바 — 새로고침·라이브·자동 갱신은 모든 대화에 한 번에 적용
+        tc1, tc2, tc3 = st.columns([1, 1, 2])
         with tc1:
             do_refresh = st.button("🔄 Refresh", use_container_width=True, key="tg_ref")
         with tc2:
-            do_clear = st.button("🗑️ Clear", use_container_width=True, key="tg_clr")
+            live_on = st.toggle("⚡ Live", value=True, key="tg_live")
         with tc3:
-            auto_on = st.toggle("Auto 60s", value=False, key="tg_auto")
+            auto_on = not live_on and st.toggle("Auto 60s", value=False, key="tg_auto")
+        
+        if live_on:
+            sub = tg_ensure_subscription(dialogs)
+            if sub is True:
+                tg_drain_updates()
+                st.session_state.tg_media_version = get_tg_media().version  # 이번 전체 실행이 반영하는 다운로드 상태
+                tg_live_listener()
+            else: st.error(f"Live failed: {sub}")
         
         if do_refresh:
             with st.spinner("⏳"):
-                if tg_fetch_messages(): st.rerun()
-                else: st.error("Fetch failed")
-        
-        if do_clear:
-            st.session_state.tg_messages = []; save_tg_history(); st.rerun()
+                st.session_state.tg_fetch_errors = tg_fetch_messages(dialogs)
+            st.rerun()
+        for dialog, err in st.session_state.pop("tg_fetch_errors", {}).items():
+            st.error(f"Fetch failed ({dialog}): {err}")
         
         # 자동 갱신 (60초)
         if auto_on:
@@ -550,7 +2396,7 @@ with tabs[-1]:
                 from streamlit_autorefresh import st_autorefresh
                 count = st_autorefresh(interval=60000, limit=None, key="tg_ar")
                 if count > 0:
-                    tg_fetch_messages()
+                    tg_fetch_messages(dialogs)
             except ImportError:
                 # fallback
                 st.markdown("""<script>
@@ -560,40 +2406,74 @@ with tabs[-1]:
                     },60000);}
                 </script>""", unsafe_allow_html=True)
         
-        # 채팅 영역
-        tg_chat = st.container(height=chat_window_height, border=False)
-        
-        with tg_chat:
-            if not st.session_state.tg_messages:
-                st.markdown('<div class="empty-state"><div class="icon">💬</div><div class="sub">No messages yet</div></div>', unsafe_allow_html=True)
-            else:
-                html = '<div class="tg-chat-area">'
-                for msg in st.session_state.tg_messages:
-                    text = (msg.get('text','')
-                            .replace('&','&amp;').replace('<','&lt;').replace('>','&gt;')
-                            .replace('\n','<br>'))
-                    t = msg.get('date','')
-                    cls = "me" if msg.get("from_me") else "bot"
-                    html += f'<div class="tg-row {cls}"><div><div class="tg-bubble {cls}">{text}</div><div class="tg-ts {cls}">{t}</div></div></div>'
-                html += '</div>'
-                st.markdown(html, unsafe_allow_html=True)
-        
-        # 입력
-        if tg_input := st.chat_input("Message...", key="tg_input"):
-            with st.spinner("Sending..."):
-                result = tg_send_via_user_api(
-                    st.session_state.tg_api_id, st.session_state.tg_api_hash,
-                    st.session_state.tg_phone, st.session_state.tg_bot_username, tg_input
-                )
-                if result is True:
-                    time.sleep(5)  # 1차 갱신: 5초 대기
-                    tg_fetch_messages()
-                    st.session_state.tg_pending_refresh = True
-                    st.rerun()
-                else:
-                    st.error(f"Failed: {result}")
+        # 대화가 여럿이면 대화별 하위 탭 (선택된 탭만 렌더링)
+        dialog_tabs = st.tabs(dialogs, key="tg_dialog_tabs", on_change="rerun") if len(dialogs) > 1 else [st.container()]
+        for dialog, dialog_tab in zip(dialogs, dialog_tabs):
+            with dialog_tab:
+                if getattr(dialog_tab, "open", True) is False: continue
+                messages = load_tg_history(dialog)  # 프로세스 공유 리스트 (복사본 아님)
+                
+                # 헤더
+                st.markdown(f"""<div class="tg-header">
+                    <div class="tg-avatar">🤖</div>
+                    <div class="tg-bot-info">
+                        <div class="name">{dialog}</div>
+                        <div class="status">● online</div>
+                    </div>
+                </div>""", unsafe_allow_html=True)
+                
+                dc1, dc2, _ = st.columns([1, 1, 4])
+                with dc1:
+                    do_older = st.button("⏫ Older", use_container_width=True, key=f"tg_older_{dialog}")
+                with dc2:
+                    do_clear = st.button("🗑️ Clear", use_container_width=True, key=f"tg_clr_{dialog}")
+                
+                if do_older:
+                    with st.spinner("⏳"):
+                        fetched = tg_fetch_older_messages(dialog)
+                    if fetched is None: st.error("Fetch failed")
+                    elif fetched: st.rerun()
+                    else: st.toast("No older messages")
+                
+                if do_clear:
+                    append_tg_history(dialog, "clear"); st.rerun()
+                
+                # 채팅 영역
+                tg_chat = st.container(height=chat_window_height, border=False)
+                
+                with tg_chat, get_metrics().span("render.telegram_tab"):
+                    if not messages:
+                        st.markdown('<div class="empty-state"><div class="icon">💬</div><div class="sub">No messages yet</div></div>', unsafe_allow_html=True)
+                    else:
+                        windows = st.session_state.setdefault("tg_render_windows", {})
+                        window = windows.get(dialog, TG_RENDER_WINDOW)
+                        hidden = len(messages) - window
+                        if hidden > 0 and st.button(f"⏫ Show earlier ({hidden} more)", key=f"tg_show_earlier_{dialog}", use_container_width=True):
+                            windows[dialog] = window + TG_RENDER_WINDOW; st.rerun()
+                        get_tg_media().prefetch(st.session_state.tg_api_id, st.session_state.tg_api_hash, st.session_state.tg_phone,
+                                       dialog, messages[-window:])
+                        focus = st.session_state.get("search_focus") or {}
+                        if focus.get("kind") == "tg" and focus.get("dialog", dialogs[0]) == dialog:
+                            st.caption(f"🔎 {focus.get('date', '')} · {focus['p'][:80]}")
+                        render_tg_transcript(messages, window)
+                        tg_attachment_downloads(dialog, messages[-window:])
+                
+                # 입력
+                if tg_input := st.chat_input(f"Message {dialog}...", key=f"tg_input_{dialog}"):
+                    with st.spinner("Sending..."):
+                        result = tg_send_via_user_api(
+                            st.session_state.tg_api_id, st.session_state.tg_api_hash,
+                            st.session_state.tg_phone, dialog, tg_input
+                        )
+                        if isinstance(result, dict):
+                            # 보낸 메시지는 바로 반영, 봇 응답은 라이브 구독으로 도착
+                            append_tg_history(dialog, "upsert", msgs=[result])
+                            st.session_state.tg_pending_refresh = not live_on
+                            st.rerun()
+                        else:
+                            st.error(f"Failed: {result}")
         
-        # 2차 갱신 (30초 후)
+        # 라이브 구독이 꺼져 있으면 30초 후 한 번 갱신
         if st.session_state.get("tg_pending_refresh", False):
             st.session_state.tg_pending_refresh = False
             st.markdown("""<script>
@@ -603,3 +2483,9 @@ with tabs[-1]:
                     b.forEach(x=>{if(x.innerText.includes('Refresh'))x.click();});
                 },30000);}
             </script>""", unsafe_allow_html=True)
+
+mark_phase("telegram")
+get_metrics().record("render.page", time.perf_counter() - page_start)
+# 로그인 후 처음 끝까지 돈 실행 = 콜드 스타트 보고서
+st.session_state.setdefault("cold_start_phases", list(RUN_PHASES))
+st.session_state.last_run_phases = list(RUN_PHASES)